@@ -0,0 +1,146 @@
+import os
+import hashlib
+import logging
+import threading
+import unicodedata
+import collections
+import numpy as np
+
+
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+class AudioCache:
+    # In-memory LRU of synthesized audio, limited by the total size of the
+    # buffers. With disk_dir set, clips are also stored as .npy files there and
+    # survive restarts; the disk store is pruned oldest first past disk_max_bytes.
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.disk_size = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_size = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.name.endswith('.npy'))
+
+    @staticmethod
+    def make_key(text, language, speaker, sample_rate):
+        return (normalize_text(text), language, speaker, sample_rate)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f'{digest}.npy')
+
+    def get(self, key):
+        with self.lock:
+            audio = self.entries.get(key)
+            if audio is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return audio
+        if self.disk_dir:
+            audio = self._load_from_disk(key)
+            if audio is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                self._remember(key, audio)
+                return audio
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, audio):
+        audio = np.asarray(audio)
+        self._remember(key, audio)
+        if self.disk_dir:
+            self._save_to_disk(key, audio)
+
+    def _remember(self, key, audio):
+        # Cached buffers are shared with playback, so they are made read-only
+        audio.flags.writeable = False
+        if audio.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.nbytes
+            self.entries[key] = audio
+            self.size += audio.nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+    def _load_from_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            audio = np.load(path)
+            os.utime(path)  # Keeps recently used files away from pruning
+            return audio
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.debug('Failed to load cached audio %s: %s', path, e)
+            return None
+
+    def _save_to_disk(self, key, audio):
+        path = self._disk_path(key)
+        temp_path = f'{path}.tmp'
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, audio)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logging.debug('Failed to store cached audio %s: %s', path, e)
+            return
+        with self.lock:
+            self.disk_size += os.path.getsize(path) - previous_size
+            over_limit = self.disk_max_bytes and self.disk_size > self.disk_max_bytes
+        if over_limit:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        files = sorted((entry for entry in os.scandir(self.disk_dir) if entry.name.endswith('.npy')),
+                       key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in files)
+        removed = 0
+        # Prune down to 90% so this does not run again on the very next store
+        for entry in files:
+            if size <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                file_size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            size -= file_size
+            removed += 1
+        with self.lock:
+            self.disk_size = size
+            self.disk_evictions += removed
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'disk_bytes': self.disk_size,
+                'disk_evictions': self.disk_evictions,
+            }
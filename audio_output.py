@@ -0,0 +1,178 @@
+import time
+import shutil
+import logging
+import threading
+import subprocess
+import numpy as np
+
+try:
+    import sounddevice
+except (ImportError, OSError):
+    sounddevice = None
+
+DEFAULT_PIPE_COMMAND = ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', '1', '-r', '{rate}']
+CHUNK_SECONDS = 0.25  # How soon an interrupt is noticed while a clip is written
+
+
+def to_pcm16(audio):
+    # float audio in [-1, 1] -> little-endian signed 16-bit samples.
+    # int16 input is passed through without a copy.
+    audio = np.asarray(audio)
+    if audio.dtype == np.dtype('<i2'):
+        return audio
+    pcm = np.clip(audio, -1.0, 1.0)
+    pcm *= 32767
+    return pcm.astype('<i2')
+
+
+def chunks(audio, sample_rate):
+    step = max(int(sample_rate * CHUNK_SECONDS), 1)
+    return (audio[start:start + step] for start in range(0, len(audio), step))
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=1.0)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    if process.stdin is not None:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass  # What was left in the pipe goes with the process
+
+
+# Both outputs play one clip at a time: play() returns once the clip has been
+# heard, or as soon as its interrupted event is set, in which case only the
+# audio of that clip is thrown away. close() interrupts the clip being played
+# and releases the device.
+
+class PipeAudioOutput:
+    # One long-lived player process per sample rate, fed raw PCM on stdin.
+    # Nothing touches the disk and no process is started per message.
+    def __init__(self, command=None):
+        self.command = command or DEFAULT_PIPE_COMMAND
+        self.processes = {}
+        self.interrupted = None  # Of the clip being played
+        self.lock = threading.Lock()
+
+    def _process(self, sample_rate):
+        with self.lock:
+            process = self.processes.get(sample_rate)
+            if process is None or process.poll() is not None:
+                args = [arg.replace('{rate}', str(sample_rate)) for arg in self.command]
+                logging.debug(f'Starting audio output: {" ".join(args)}')
+                # stderr is dropped, aplay reports an underrun every time it goes idle
+                process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                self.processes[sample_rate] = process
+            return process
+
+    def play(self, audio, sample_rate, interrupted=None):
+        interrupted = interrupted or threading.Event()
+        if interrupted.is_set():
+            return
+        pcm = np.ascontiguousarray(to_pcm16(audio))
+        process = self._process(sample_rate)
+        with self.lock:
+            self.interrupted = interrupted
+        try:
+            # The pipe takes the audio well before it is heard, so the clip
+            # counts as playing until its duration has passed
+            ends = time.monotonic() + len(pcm) / sample_rate
+            try:
+                for chunk in chunks(pcm, sample_rate):
+                    if interrupted.is_set():
+                        break
+                    process.stdin.write(memoryview(chunk).cast('B'))
+                    process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                logging.debug('Audio output process exited, it will be restarted with the next clip.')
+                return
+            if not interrupted.wait(max(ends - time.monotonic(), 0.0)):
+                return
+            # Whatever is still buffered belongs to this clip; the process
+            # is stopped and the next clip starts a new one
+            with self.lock:
+                if self.processes.get(sample_rate) is process:
+                    del self.processes[sample_rate]
+            stop_process(process)
+        finally:
+            with self.lock:
+                if self.interrupted is interrupted:
+                    self.interrupted = None
+
+    def close(self):
+        # Stops playback right away, including audio still buffered in the pipe
+        with self.lock:
+            processes, self.processes = self.processes, {}
+            if self.interrupted is not None:
+                self.interrupted.set()
+        for process in processes.values():
+            stop_process(process)
+
+
+class SoundDeviceAudioOutput:
+    # PortAudio output streams kept open per sample rate; float32 audio is
+    # handed to the stream as is
+    def __init__(self):
+        self.streams = {}
+        self.interrupted = None  # Of the clip being played
+        self.lock = threading.Lock()
+
+    def _stream(self, sample_rate):
+        with self.lock:
+            stream = self.streams.get(sample_rate)
+            if stream is None:
+                stream = sounddevice.OutputStream(samplerate=sample_rate, channels=1, dtype='float32')
+                stream.start()
+                self.streams[sample_rate] = stream
+            return stream
+
+    def play(self, audio, sample_rate, interrupted=None):
+        interrupted = interrupted or threading.Event()
+        audio = np.asarray(audio, dtype=np.float32).reshape(-1, 1)
+        stream = self._stream(sample_rate)
+        with self.lock:
+            self.interrupted = interrupted
+        try:
+            # write() blocks until the audio is in PortAudio's buffer, a
+            # chunk at a time so an interrupt is noticed
+            for chunk in chunks(audio, sample_rate):
+                if interrupted.is_set():
+                    break
+                stream.write(chunk)
+            if not interrupted.wait(stream.latency):
+                return
+            with self.lock:
+                if self.streams.get(sample_rate) is not stream:
+                    return  # Closed already
+                del self.streams[sample_rate]
+            stream.abort()
+            stream.close()
+        finally:
+            with self.lock:
+                if self.interrupted is interrupted:
+                    self.interrupted = None
+
+    def close(self):
+        with self.lock:
+            streams, self.streams = self.streams, {}
+            if self.interrupted is not None:
+                self.interrupted.set()
+        for stream in streams.values():
+            stream.abort()
+            stream.close()
+
+
+def create_audio_output(audio_settings):
+    backend = audio_settings.get('backend', 'auto')
+    if backend == 'sounddevice' or (backend == 'auto' and sounddevice is not None):
+        if sounddevice is not None:
+            return SoundDeviceAudioOutput()
+        logging.warning('sounddevice is not installed, falling back to a pipe audio output.')
+    command = audio_settings.get('pipe_command') or DEFAULT_PIPE_COMMAND
+    if shutil.which(command[0]) is None:
+        logging.warning(f'Audio output command {command[0]} not found.')
+    return PipeAudioOutput(command)
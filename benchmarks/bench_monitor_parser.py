@@ -0,0 +1,107 @@
+import os
+import re
+import sys
+import io
+import glob
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbus_monitor import DbusMonitorParser
+
+CAPTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captures')
+STRING_RE = re.compile(r'string "([^"]+)"')
+TIME_RE = re.compile(r'signal time=(\d+\.\d+)')
+
+# The old reader logged every line at DEBUG; records go to /dev/null here so only formatting
+# and handling are measured
+LOGGER = logging.getLogger('bench_monitor_parser')
+LOGGER.setLevel(logging.DEBUG)
+LOGGER.propagate = False
+LOGGER.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+
+
+def parse_incremental(data, chunk_size):
+    parser = DbusMonitorParser()
+    notifications = 0
+    for start in range(0, len(data), chunk_size):
+        for message in parser.feed(data[start:start + chunk_size]):
+            notifications += message.member == 'Notify'
+    for message in parser.close():
+        notifications += message.member == 'Notify'
+    return notifications
+
+
+def parse_lines(data, chunk_size):
+    # The previous loop: one readline, decode, DEBUG log record and set of
+    # regexes per line. It also missed multi-line strings and cut strings at
+    # the first quote, so it did less work than a real parser.
+    notifications = 0
+    sequential_strings = []
+    stream = io.BufferedReader(io.BytesIO(data), buffer_size=chunk_size)
+    for raw_line in iter(stream.readline, b''):
+        line = raw_line.decode('utf-8').strip()
+        LOGGER.debug(f'Intercepted line: {line}')
+        TIME_RE.search(line)
+        if 'member=Notify' in line:
+            notifications += 1
+            sequential_strings = []
+        string_match = STRING_RE.search(line)
+        if string_match:
+            sequential_strings.append(string_match.group(1))
+        if 'signal time=' in line and 'member=NotificationClosed' in line:
+            sequential_strings = []
+    return notifications
+
+
+PARSERS = {'incremental': parse_incremental, 'lines': parse_lines}
+
+
+def bench_parser(parse, data, chunk_size, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        notifications = parse(data, chunk_size)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'seconds': best,
+        'notifications': notifications,
+        'mib_per_second': len(data) / best / 2 ** 20,
+        'notifications_per_second': notifications / best,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the dbus-monitor output parsers on recorded captures')
+    parser.add_argument('captures', nargs='*', help='dbus-monitor captures (default: benchmarks/captures/*.txt)')
+    parser.add_argument('--parsers', nargs='+', default=list(PARSERS), choices=list(PARSERS))
+    parser.add_argument('--copies', type=int, default=200, help='how many times each capture is repeated')
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    captures = args.captures or sorted(glob.glob(os.path.join(CAPTURES_DIR, '*.txt')))
+    results = {}
+    for capture in captures:
+        with open(capture, 'rb') as f:
+            data = f.read() * args.copies
+        name = os.path.basename(capture)
+        for parser_name in args.parsers:
+            result = bench_parser(PARSERS[parser_name], data, args.chunk_size, args.repeat)
+            results[f'{name}/{parser_name}'] = result
+            print(f'{name} {parser_name:>11}: {result["mib_per_second"]:.1f} MiB/s, '
+                  f'{result["notifications_per_second"]:.0f} notifications/s '
+                  f'({result["notifications"]} notifications in {len(data) / 2 ** 20:.1f} MiB)')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'chunk_size': args.chunk_size, 'copies': args.copies, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
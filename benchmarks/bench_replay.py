@@ -0,0 +1,322 @@
+import os
+import sys
+import glob
+import json
+import time
+import random
+import resource
+import argparse
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from noti_reader import NotificationReader
+from dbus_monitor import DbusMonitorParser
+
+CAPTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captures')
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.json')
+PERCENTILES = (50, 95, 99)
+BENCH_SENDER = ':1.bench'
+
+
+class FakeEngine:
+    # Stands in for a TTS model: returns silence as long as the text would
+    # take to say (chars_per_second), after computing for rtf times as long.
+    # Texts are computed one at a time, so the pipeline does not batch them.
+    supports_batching = False
+
+    def __init__(self, language, rtf=0.1, sample_rate=24000, chars_per_second=15.0):
+        self.language = language
+        self.rtf = rtf
+        self.sample_rate = sample_rate
+        self.chars_per_second = chars_per_second
+        self.speaker = 'fake'
+        self.model_key = ('fake', language)
+
+    def load(self):
+        pass
+
+    def synthesize(self, text):
+        seconds = max(len(text), 1) / self.chars_per_second
+        if self.rtf:
+            time.sleep(seconds * self.rtf)
+        return np.zeros(int(seconds * self.sample_rate), dtype=np.float32)
+
+    def synthesize_batch(self, texts):
+        return [self.synthesize(text) for text in texts]
+
+
+class NullAudioOutput:
+    # Plays nothing. With speed set, play() takes as long as the audio would
+    # last divided by speed, so playback backpressure is still there; setting
+    # the clip's interrupted event or close() cuts it short like the real
+    # outputs.
+    def __init__(self, speed=0.0):
+        self.speed = speed
+        self.interrupted = None  # Of the clip being played
+
+    def play(self, audio, sample_rate, interrupted=None):
+        self.interrupted = interrupted = interrupted or threading.Event()
+        if self.speed:
+            interrupted.wait(len(audio) / sample_rate / self.speed)
+
+    def close(self):
+        if self.interrupted is not None:
+            self.interrupted.set()
+
+
+def percentiles(values):
+    # Nearest-rank percentiles in milliseconds
+    if not values:
+        return {f'p{p}_ms': None for p in PERCENTILES}
+    ordered = sorted(values)
+    result = {}
+    for p in PERCENTILES:
+        rank = max(1, int(np.ceil(p / 100 * len(ordered))))
+        result[f'p{p}_ms'] = ordered[rank - 1] * 1000
+    result['max_ms'] = ordered[-1] * 1000
+    return result
+
+
+def load_capture(path, copies):
+    # [(seconds since the first message, message)] from a dbus-monitor capture;
+    # copies are played one after another
+    with open(path, 'rb') as f:
+        data = f.read()
+    parser = DbusMonitorParser()
+    messages = parser.feed(data) + parser.close()
+    times = [float(message.fields['time']) for message in messages if 'time' in message.fields]
+    first = min(times) if times else 0.0
+    length = (max(times) - first if times else 0.0) + 0.1
+    trace = []
+    for copy in range(copies):
+        for message in messages:
+            offset = float(message.fields.get('time', first)) - first
+            trace.append((copy * length + offset, message))
+    return trace
+
+
+def synthetic_trace(bursts, burst_size, burst_gap, spacing, sources, seed):
+    # [(seconds, (source, strings))]: bursts of burst_size notifications,
+    # spacing apart, with burst_gap seconds between the starts of bursts.
+    # Texts come from the RTF corpus, so both languages show up.
+    with open(CORPUS_PATH, 'r') as f:
+        corpus = json.load(f)
+    texts = [text for language_texts in corpus.values() for text in language_texts]
+    rng = random.Random(seed)
+    trace = []
+    for burst in range(bursts):
+        for i in range(burst_size):
+            source = rng.choice(sources)
+            trace.append((burst * burst_gap + i * spacing, (source, [source, f'{source} #{i}', rng.choice(texts)])))
+    return trace
+
+
+class ReplayBench:
+    # Runs a NotificationReader without D-Bus: the trace is fed to its
+    # assembler (what the listeners do), and filtering, synthesis and
+    # playback run on the real pipeline with the configured engine and sink
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = threading.Lock()
+        # {id(notification) or id(summary): seconds from receipt to first audio}
+        self.first_audio = {}
+        self.summaries = 0
+        self.summarized = 0
+        self.rule_times = []
+        self.filter_times = []
+        self.serial = 0
+
+        apply_advanced_rule = reader.apply_advanced_rule
+        filter_notification = reader.filter_notification
+
+        def timed_rules(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return apply_advanced_rule(*args, **kwargs)
+            finally:
+                self.rule_times.append(time.perf_counter() - started)
+
+        def timed_filter(notification):
+            started = time.perf_counter()
+            try:
+                return filter_notification(notification)
+            finally:
+                self.filter_times.append(time.perf_counter() - started)
+
+        def recording_playback(clip):
+            if clip.first and not clip.utterance.cancelled:
+                self.record_first_audio(clip.utterance)
+            reader.play_clip(clip)
+
+        reader.apply_advanced_rule = timed_rules
+        reader.pipeline.handlers = (timed_filter, reader.synthesize_batch, recording_playback)
+
+    def record_first_audio(self, utterance):
+        elapsed = time.monotonic() - utterance.received
+        with self.lock:
+            if utterance.notification is None:
+                # A burst summary is heard once for all the notifications it replaced
+                self.summaries += 1
+                self.summarized += utterance.count
+                self.first_audio[id(utterance)] = elapsed
+            else:
+                self.first_audio.setdefault(id(utterance.notification), elapsed)
+
+    def feed(self, item):
+        if isinstance(item, tuple):
+            _, strings = item
+            self.serial += 1
+            self.reader.assembler.notify(BENCH_SENDER, self.serial, strings)
+        else:
+            self.reader.handle_monitor_message(item)
+
+    def idle(self):
+        pipeline = self.reader.pipeline
+        return not any(len(queue) for queue in pipeline.queues) and not any(stage.busy for stage in pipeline.stages)
+
+    def run(self, trace, speed, drain_timeout):
+        reader = self.reader
+        reader.warm_up()
+        reader.pipeline.start()
+        notifications = 0
+        started = time.monotonic()
+        try:
+            for offset, item in trace:
+                if speed:
+                    delay = started + offset / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                if isinstance(item, tuple) or item.member == 'Notify':
+                    notifications += 1
+                self.feed(item)
+            fed = time.monotonic() - started
+            # Done once every queue is empty and no stage holds anything
+            deadline = time.monotonic() + drain_timeout
+            idle_since = None
+            while time.monotonic() < deadline:
+                if not self.idle():
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since > 0.05:
+                    break
+                time.sleep(0.005)
+            elapsed = time.monotonic() - started
+        finally:
+            stats = reader.get_stats()
+            reader.shut_down()
+
+        read = len(self.first_audio) - self.summaries
+        return {
+            'notifications': notifications,
+            'read': read,
+            'summaries': self.summaries,
+            'summarized_notifications': self.summarized,
+            'feed_seconds': fed,
+            'seconds': elapsed,
+            'notifications_per_second': notifications / elapsed if elapsed else None,
+            'read_per_second': read / elapsed if elapsed else None,
+            'first_audio': percentiles(list(self.first_audio.values())),
+            'rules': percentiles(self.rule_times),
+            'filter': percentiles(self.filter_times),
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'reader': stats,
+        }
+
+
+def create_reader(args):
+    reader = NotificationReader()
+    if args.engine == 'fake':
+        reader.engines = {language: FakeEngine(language, args.fake_rtf) for language in reader.engines}
+    if args.sink == 'null':
+        reader.audio_output = NullAudioOutput(args.playback_speed)
+    if args.no_dedup:
+        reader.dedup = None
+    # Rules come from the reader's files unless given here; nothing is saved
+    source_rules = advanced_rules = None
+    if args.source_rules:
+        with open(args.source_rules, 'r') as f:
+            source_rules = json.load(f)
+    if args.advanced_rules:
+        with open(args.advanced_rules, 'r') as f:
+            advanced_rules = json.load(f)
+    reader.publish_rules(source_rules, advanced_rules, save=False)
+    return reader
+
+
+def compare(results, baseline_path):
+    # Relative change of the headline numbers against an earlier --json file
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['results']
+    metrics = [('notifications_per_second', None)] + [('first_audio', f'p{p}_ms') for p in PERCENTILES] + \
+              [('rules', 'p95_ms'), ('max_rss_bytes', None)]
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric, key in metrics:
+            old, new = before.get(metric), result.get(metric)
+            if key is not None:
+                old, new = (old or {}).get(key), (new or {}).get(key)
+            if old and new is not None:
+                changes.append(f'{metric}{"." + key if key else ""} {(new - old) / old * 100:+.1f}%')
+        print(f'{name} vs baseline: {", ".join(changes)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end latency of the reader on replayed or synthetic notifications')
+    parser.add_argument('captures', nargs='*', help='dbus-monitor captures (default: benchmarks/captures/*.txt)')
+    parser.add_argument('--synthetic', action='store_true', help='use a synthetic burst trace instead of captures')
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--burst-size', type=int, default=10)
+    parser.add_argument('--burst-gap', type=float, default=2.0, help='seconds between the starts of bursts')
+    parser.add_argument('--spacing', type=float, default=0.01, help='seconds between notifications of a burst')
+    parser.add_argument('--sources', nargs='+', default=['Telegram', 'Thunderbird', 'Slack', 'Firefox'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--copies', type=int, default=5, help='how many times each capture is replayed')
+    parser.add_argument('--speed', type=float, default=1.0, help='trace time scale; 0 feeds everything at once')
+    parser.add_argument('--engine', choices=['fake', 'real'], default='fake')
+    parser.add_argument('--fake-rtf', type=float, default=0.1, help='real-time factor of the fake engine')
+    parser.add_argument('--sink', choices=['null', 'real'], default='null')
+    parser.add_argument('--playback-speed', type=float, default=0.0,
+                        help='null sink: play at this multiple of real time; 0 returns at once')
+    parser.add_argument('--no-dedup', action='store_true')
+    parser.add_argument('--source-rules', help='source rules JSON to use instead of the reader\'s')
+    parser.add_argument('--advanced-rules', help='advanced rules JSON to use instead of the reader\'s')
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='earlier --json results to compare with')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        traces = {'synthetic': synthetic_trace(args.bursts, args.burst_size, args.burst_gap, args.spacing,
+                                               args.sources, args.seed)}
+    else:
+        captures = args.captures or sorted(glob.glob(os.path.join(CAPTURES_DIR, '*.txt')))
+        traces = {os.path.basename(capture): load_capture(capture, args.copies) for capture in captures}
+
+    results = {}
+    for name, trace in traces.items():
+        result = ReplayBench(create_reader(args)).run(trace, args.speed, args.drain_timeout)
+        results[f'{name}/{args.engine}'] = result
+        first_audio = result['first_audio']
+        print(f'{name} {args.engine}: {result["notifications"]} notifications, {result["read"]} read, '
+              f'{result["summaries"]} summaries '
+              f'in {result["seconds"]:.2f}s ({result["notifications_per_second"]:.1f}/s); first audio '
+              + ', '.join(f'p{p} {first_audio[f"p{p}_ms"] or 0:.1f}ms' for p in PERCENTILES)
+              + f'; rules p95 {result["rules"]["p95_ms"] or 0:.3f}ms; '
+              f'max RSS {result["max_rss_bytes"] / 2 ** 20:.0f} MiB')
+
+    if args.json:
+        settings = {key: value for key, value in vars(args).items() if key not in ('json', 'baseline')}
+        with open(args.json, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
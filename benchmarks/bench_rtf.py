@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import load_settings
+from model_store import ModelStore, MODELS_DIR
+from tts_engines import create_engines, registry
+
+# Inference profiles compared on the same corpus
+MODES = {
+    'default': {'num_threads': 0, 'quantize': 'none', 'optimize_jit': False},
+    'threads-2': {'num_threads': 2, 'quantize': 'none', 'optimize_jit': False},
+    'int8': {'num_threads': 2, 'quantize': 'dynamic_int8', 'optimize_jit': False},
+    'jit': {'num_threads': 2, 'quantize': 'none', 'optimize_jit': True},
+}
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.json')
+
+
+def bench_engine(engine, texts, repeat):
+    engine.load()
+    engine.synthesize(texts[0])  # First call pays for lazy initialization
+    synthesis_seconds = 0.0
+    audio_seconds = 0.0
+    for _ in range(repeat):
+        for text in texts:
+            started = time.perf_counter()
+            audio = engine.synthesize(text)
+            synthesis_seconds += time.perf_counter() - started
+            audio_seconds += len(audio) / engine.sample_rate
+    return {
+        'synthesis_seconds': synthesis_seconds,
+        'audio_seconds': audio_seconds,
+        # Real-time factor: seconds of computation per second of speech
+        'rtf': synthesis_seconds / audio_seconds if audio_seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Real-time factor of the TTS engines per inference profile')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--languages', nargs='+', default=['ru', 'en'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    import torch
+    settings = load_settings()
+    with open(CORPUS_PATH, 'r') as f:
+        corpus = json.load(f)
+    store = ModelStore(MODELS_DIR)
+    results = {}
+
+    for mode in args.modes:
+        inference = MODES[mode]
+        torch.set_num_threads(inference['num_threads'] or os.cpu_count())
+        engines = create_engines(settings['tts'], store, settings['models']['allow_download'], inference)
+        for language in args.languages:
+            if language not in engines:
+                continue
+            result = bench_engine(engines[language], corpus[language], args.repeat)
+            result['model_bytes'] = registry.info[engines[language].model_key]['bytes']
+            results[f'{mode}/{language}'] = result
+            print(f'{mode:>10} {language}: RTF {result["rtf"]:.3f} '
+                  f'({result["synthesis_seconds"]:.2f}s for {result["audio_seconds"]:.2f}s of audio, '
+                  f'model {result["model_bytes"] / 2 ** 20:.1f} MiB)')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'torch': torch.__version__, 'threads': torch.get_num_threads(), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import asyncio
+import logging
+import tempfile
+import argparse
+import threading
+
+# The reader daemon and its clients talk over a Unix socket that only the
+# user can open, one JSON object per line:
+#
+#   -> {"id": 1, "method": "set_advanced_rule", "params": {"source": "Telegram", ...}}
+#   <- {"id": 1, "result": true}            or {"id": 1, "error": "..."}
+#
+# After {"method": "subscribe"} the connection also gets events, which have
+# no id: {"event": "reading", "text": "..."} and {"event": "status", ...}.
+
+MAX_LINE_BYTES = 16 * 1024 * 1024  # All rules in one request must fit
+MAX_EVENT_BACKLOG = 1024 * 1024  # A subscriber this far behind is disconnected
+
+
+class ControlError(Exception):
+    pass
+
+
+def runtime_dir():
+    # XDG_RUNTIME_DIR belongs to the user alone. Without it the socket goes
+    # into a directory of our own under the shared temp dir, which is checked
+    # before use, since any local user could have created that path first.
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if directory:
+        return directory
+    directory = os.path.join(tempfile.gettempdir(), f'noti_reader-{os.getuid()}')
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+        raise ControlError(f'{directory} is not a private directory of this user; '
+                           f'set XDG_RUNTIME_DIR or the control socket in settings.json')
+    return directory
+
+
+def default_socket_path():
+    return os.path.join(runtime_dir(), f'noti_reader-{os.getuid()}.sock')
+
+
+def socket_path(control_settings):
+    return control_settings.get('socket') or default_socket_path()
+
+
+def encode(message):
+    # Stats may hold tuples or other values JSON has no type for
+    return (json.dumps(message, default=str) + '\n').encode('utf-8')
+
+
+class ControlServer:
+    # Serves handlers ({method: callable(**params)}, coroutines allowed) on
+    # the control socket from the daemon's event loop. publish() must be
+    # called on the loop too (call_soon_threadsafe from other threads).
+    def __init__(self, path, handlers):
+        self.path = path
+        self.handlers = handlers
+        self.clients = {}  # {writer: task serving it}
+        self.subscribers = set()
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # A socket left by a daemon that did not exit cleanly is replaced,
+            # one that still answers means a daemon is running
+            try:
+                _, writer = await asyncio.open_unix_connection(self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)
+            else:
+                writer.close()
+                raise ControlError(f'A reader daemon is already running on {self.path}')
+        # Created user-only from the start, a chmod afterwards would leave a
+        # moment in which others could connect
+        umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle_client, path=self.path, limit=MAX_LINE_BYTES)
+        finally:
+            os.umask(umask)
+        logging.info(f'Control socket listening on {self.path}')
+
+    async def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        # Closed connections read as EOF, so the client tasks end by themselves
+        clients = list(self.clients.items())
+        for writer, _ in clients:
+            writer.close()
+        await asyncio.gather(*(task for _, task in clients), return_exceptions=True)
+        await self.server.wait_closed()
+        self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle_client(self, reader, writer):
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(encode(await self.handle_request(line, writer)))
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            logging.debug('Control client disconnected: %s', e)
+        finally:
+            self.clients.pop(writer, None)
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def handle_request(self, line, writer):
+        try:
+            request = json.loads(line)
+            method = request['method']
+        except (ValueError, KeyError, TypeError):
+            return {'id': None, 'error': 'Malformed request'}
+        response = {'id': request.get('id')}
+        if method == 'subscribe':
+            self.subscribers.add(writer)
+            response['result'] = True
+            return response
+        handler = self.handlers.get(method)
+        if handler is None:
+            response['error'] = f'Unknown method: {method}'
+            return response
+        try:
+            result = handler(**(request.get('params') or {}))
+            if asyncio.iscoroutine(result):
+                result = await result
+            response['result'] = result
+        except Exception as e:
+            logging.debug('Control request %s failed: %s', method, e)
+            response['error'] = f'{type(e).__name__}: {e}'
+        return response
+
+    def publish(self, event, **data):
+        message = encode(dict(data, event=event))
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > MAX_EVENT_BACKLOG:
+                self.subscribers.discard(writer)
+                writer.close()
+                continue
+            writer.write(message)
+
+
+class ControlClient:
+    # Blocking client for the GUI and the command line. Calls go over one
+    # connection, opened on first use and again after the daemon restarts;
+    # wait is how long to keep trying while the daemon is starting up, and a
+    # call the daemon does not answer within timeout fails with ControlError.
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.file = None
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def connect(self, wait=0.0):
+        deadline = time.monotonic() + wait
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise ControlError(f'No reader daemon on {self.path}')
+                time.sleep(0.1)
+
+    def call(self, method, params=None, wait=0.0):
+        with self.lock:
+            for attempt in range(2):
+                if self.sock is None:
+                    self.sock = self.connect(wait)
+                    self.file = self.sock.makefile('rwb')
+                self.next_id += 1
+                try:
+                    self.file.write(encode({'id': self.next_id, 'method': method, 'params': params or {}}))
+                    self.file.flush()
+                    line = self.file.readline()
+                except socket.timeout:
+                    # Not retried, the request may still be carried out
+                    self.close_connection()
+                    raise ControlError(f'The reader daemon did not answer {method} in time')
+                except OSError:
+                    line = b''
+                if line:
+                    break
+                # The daemon went away (or restarted) since the last call
+                self.close_connection()
+                if attempt:
+                    raise ControlError('The reader daemon closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ControlError(response['error'])
+        return response.get('result')
+
+    def close_connection(self):
+        if self.sock is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass  # Nothing left to flush to a daemon that is gone
+            self.sock.close()
+        self.sock = self.file = None
+
+    def close(self):
+        with self.lock:
+            self.close_connection()
+
+    def events(self, wait=0.0):
+        # Yields events from a connection of their own until the daemon goes
+        # away; the socket is yielded first so another thread can shut it down
+        sock = self.connect(wait)
+        sock.settimeout(None)
+        with sock, sock.makefile('rwb') as f:
+            yield sock
+            f.write(encode({'id': 0, 'method': 'subscribe'}))
+            f.flush()
+            for line in f:
+                message = json.loads(line)
+                if 'event' in message:
+                    yield message
+
+
+def main():
+    from settings import load_settings
+    parser = argparse.ArgumentParser(description='Send a command to the running reader daemon')
+    parser.add_argument('method', help='e.g. status, start, stop, get_stats, get_rules, shutdown, events')
+    parser.add_argument('params', nargs='?', help='parameters as a JSON object')
+    parser.add_argument('--socket', help='control socket (default: from settings.json)')
+    args = parser.parse_args()
+
+    try:
+        client = ControlClient(args.socket or socket_path(load_settings()['control']))
+        if args.method == 'events':
+            events = client.events()
+            next(events)
+            for event in events:
+                print(json.dumps(event, ensure_ascii=False), flush=True)
+            return
+        result = client.call(args.method, json.loads(args.params) if args.params else None)
+    except ControlError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        return
+    print(json.dumps(result, indent=2, ensure_ascii=False, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import time
+import asyncio
+import logging
+import collections
+from pipeline import Notification
+from log_setup import SampledTrace
+
+try:
+    from jeepney import MessageType, HeaderFields
+    from jeepney.bus_messages import MatchRule, Monitoring
+    from jeepney.io.asyncio import open_dbus_connection
+except ImportError:
+    open_dbus_connection = None
+
+NOTIFICATIONS_INTERFACE = 'org.freedesktop.Notifications'
+NOTIFICATIONS_BUS_NAME = 'org.freedesktop.Notifications'
+MAX_TRACKED_NOTIFICATIONS = 256
+trace_message = SampledTrace('noti_reader.dbus')
+
+
+def native_listener_available():
+    return open_dbus_connection is not None
+
+
+def notification_entries(app_name, app_icon, summary, body, actions=(), hints=None):
+    # The same strings, in the same order, that dbus-monitor prints for a
+    # Notify call, so "Entry N" in existing rules keeps pointing at the same text
+    entries = [s for s in (app_name, app_icon, summary, body) if s]
+    entries.extend(action for action in actions if action)
+    for key, value in (hints or {}).items():
+        entries.append(key)
+        # Variants arrive as (signature, value)
+        if isinstance(value, tuple) and len(value) == 2 and value[0] == 's' and value[1]:
+            entries.append(value[1])
+    return entries
+
+
+class NotificationAssembler:
+    # Turns the Notify traffic seen on the bus into notifications, the moment
+    # a Notify call is complete, and keeps track of what happens to them next:
+    # - the server's reply to Notify carries the notification id
+    #   (matched to the call by sender and serial), handed to on_id
+    # - a later Notify with replaces_id, or a NotificationClosed signal, then
+    #   names that id and is handed to on_replaced / on_closed
+    # Both maps are bounded, old notifications are forgotten first.
+    def __init__(self, on_notification, on_closed=None, on_id=None):
+        self.on_notification = on_notification
+        self.on_closed = on_closed
+        self.on_id = on_id
+        self.awaiting_id = collections.OrderedDict()  # {(sender, serial): notification}
+        self.by_id = collections.OrderedDict()  # {notification id: notification}
+
+    def notify(self, sender, serial, entries, replaces_id=0, received=None):
+        notification = Notification(entries, received=received, replaces_id=replaces_id)
+        if replaces_id:
+            # The replacement keeps the id of the notification it replaces
+            notification.replaces = self.by_id.get(replaces_id)
+            notification.notification_id = replaces_id
+            self._remember(self.by_id, replaces_id, notification)
+        else:
+            self._remember(self.awaiting_id, (sender, serial), notification)
+        self.on_notification(notification)
+        return notification
+
+    def reply(self, destination, reply_serial, notification_id):
+        notification = self.awaiting_id.pop((destination, reply_serial), None)
+        if notification is None or not isinstance(notification_id, int):
+            return
+        notification.notification_id = notification_id
+        self._remember(self.by_id, notification_id, notification)
+        if self.on_id is not None:
+            self.on_id(notification)
+
+    def closed(self, notification_id, reason):
+        notification = self.by_id.pop(notification_id, None)
+        if notification is not None and self.on_closed is not None:
+            self.on_closed(notification, reason)
+
+    def _remember(self, mapping, key, notification):
+        mapping[key] = notification
+        mapping.move_to_end(key)
+        if len(mapping) > MAX_TRACKED_NOTIFICATIONS:
+            mapping.popitem(last=False)
+
+
+class NativeNotificationListener:
+    # Receives Notify calls as structured messages by turning a D-Bus
+    # connection into a monitor, instead of scraping dbus-monitor output.
+    # bus_address is 'SESSION' or any D-Bus address, e.g. the one printed by
+    # `dbus-daemon --session --print-address --fork` for a private test bus.
+    def __init__(self, bus_address='SESSION'):
+        self.bus_address = bus_address
+
+    async def listen(self, assembler, record=None):
+        # Runs until cancelled; the connection is closed on the way out
+        connection = await open_dbus_connection(bus=self.bus_address)
+        try:
+            rules = [
+                MatchRule(type='method_call', interface=NOTIFICATIONS_INTERFACE, member='Notify').serialise(),
+                # Replies of the notification server, they carry the notification ids
+                MatchRule(type='method_return', sender=NOTIFICATIONS_BUS_NAME).serialise(),
+                MatchRule(type='signal', interface=NOTIFICATIONS_INTERFACE, member='NotificationClosed').serialise(),
+            ]
+            await asyncio.wait_for(self.become_monitor(connection, rules), timeout=5)
+            logging.debug(f'Listening for notifications on D-Bus: {self.bus_address}')
+
+            while True:
+                message = await connection.receive()
+                parse_started = time.monotonic()
+                if self.parse_message(message, assembler) and record is not None:
+                    record('parse', time.monotonic() - parse_started)
+        finally:
+            await connection.close()
+
+    async def become_monitor(self, connection, rules):
+        serial = next(connection.outgoing_serial)
+        await connection.send(Monitoring().BecomeMonitor(rules), serial=serial)
+        while True:
+            reply = await connection.receive()
+            if reply.header.fields.get(HeaderFields.reply_serial) != serial:
+                continue
+            if reply.header.message_type == MessageType.error:
+                raise RuntimeError(f'BecomeMonitor failed: {reply.body}')
+            return
+
+    def parse_message(self, message, assembler):
+        # Returns True when the message was a new notification
+        header = message.header
+        fields = header.fields
+        trace_message('Intercepted %s %s', header.message_type.name, fields.get(HeaderFields.member))
+        if header.message_type == MessageType.method_return:
+            if message.body:
+                assembler.reply(fields.get(HeaderFields.destination), fields.get(HeaderFields.reply_serial),
+                                message.body[0])
+            return False
+        if header.message_type == MessageType.signal:
+            if fields.get(HeaderFields.member) == 'NotificationClosed' and len(message.body) == 2:
+                assembler.closed(*message.body)
+            return False
+        if header.message_type != MessageType.method_call or fields.get(HeaderFields.member) != 'Notify':
+            return False
+        try:
+            app_name, replaces_id, app_icon, summary, body, actions, hints, expire_timeout = message.body
+        except ValueError:
+            logging.debug('Ignoring Notify call with unexpected arguments: %s', message.body)
+            return False
+        entries = notification_entries(app_name, app_icon, summary, body, actions, hints)
+        assembler.notify(fields.get(HeaderFields.sender), header.serial, entries, replaces_id, time.monotonic())
+        return True
@@ -0,0 +1,272 @@
+import re
+import time
+import asyncio
+import logging
+from log_setup import SampledTrace
+
+# dbus-monitor prints every message as a header line at column 0 followed by
+# one indented line per argument, nested containers indented further:
+#
+#   method call time=1700000000.1 sender=:1.45 -> destination=:1.12 serial=7 path=/org/freedesktop/Notifications; interface=org.freedesktop.Notifications; member=Notify
+#      string "Telegram"
+#      uint32 0
+#      ...
+#      array [
+#         dict entry(
+#            string "urgency"
+#            variant             byte 1
+#         )
+#      ]
+#      int32 -1
+#
+# Strings are printed as they are, without escaping, so a string may span
+# several lines and contain quotes.
+
+READ_SIZE = 64 * 1024
+trace_line = SampledTrace('noti_reader.dbus_monitor')
+MESSAGE_KINDS = ('method call', 'method return', 'signal', 'error')
+HEADER_FIELD_RE = re.compile(r'([a-z_]+)=([^\s;]+)')
+OPEN_CONTAINERS = {'array [': list, 'dict entry(': tuple, 'struct {': tuple, 'array of bytes [': list}
+CLOSE_CONTAINERS = (']', ')', '}')
+INTEGER_TYPES = ('byte', 'int16', 'uint16', 'int32', 'uint32', 'int64', 'uint64', 'unix_fd')
+VALUE_TYPES = INTEGER_TYPES + ('string', 'object path', 'signature', 'boolean', 'double', 'variant', 'file descriptor')
+
+# Messages whose number of arguments is known are emitted as soon as the last
+# one is parsed, instead of when the next message starts
+EXPECTED_ARGUMENTS = {
+    'Notify': 8,
+    'NotificationClosed': 2,
+    'ActionInvoked': 2,
+}
+
+
+class MonitorMessage:
+    def __init__(self, kind, fields):
+        self.kind = kind
+        self.fields = fields  # e.g. {'member': 'Notify', 'serial': '7', ...}
+        self.args = []
+
+    @property
+    def member(self):
+        return self.fields.get('member')
+
+    def int_field(self, name):
+        try:
+            return int(self.fields[name])
+        except (KeyError, ValueError):
+            return None
+
+    def strings(self):
+        # Every non-empty string argument in the order dbus-monitor prints
+        # them, nested ones included (the "entries" rules refer to)
+        found = []
+        stack = [self.args]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, str):
+                if value:
+                    found.append(value)
+            elif isinstance(value, (list, tuple)):
+                stack.extend(reversed(value))
+        return found
+
+
+def is_structural(line):
+    # Whether a line is something dbus-monitor prints itself (a header or an
+    # argument), as opposed to the continuation of a multi-line string
+    if line.startswith(MESSAGE_KINDS):
+        return True
+    stripped = line.lstrip(' ')
+    if stripped == line:
+        return False
+    return stripped in CLOSE_CONTAINERS or stripped in OPEN_CONTAINERS or stripped.startswith(VALUE_TYPES)
+
+
+class DbusMonitorParser:
+    # Incremental parser for dbus-monitor output. feed() takes raw bytes in
+    # chunks of any size and returns the messages completed by them; a chunk
+    # is decoded once, and only complete lines are parsed. close() returns
+    # the last message at end of input.
+    def __init__(self):
+        self.remainder = b''
+        self.message = None
+        self.expected = None  # Number of arguments of the current message, when known
+        self.containers = []  # Open arrays, dict entries and structs, innermost last
+        self.string_parts = None  # Lines of a string that is not known to be complete
+        self.string_closed = False  # Whether the last of those lines ended with a quote
+        self.completed = []
+
+    def feed(self, data):
+        data = self.remainder + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            self.remainder = data
+            return []
+        self.remainder = data[end + 1:]
+        for line in data[:end].decode('utf-8', errors='replace').split('\n'):
+            self.parse_line(line)
+        completed, self.completed = self.completed, []
+        return completed
+
+    def close(self):
+        if self.remainder:
+            self.parse_line(self.remainder.decode('utf-8', errors='replace'))
+            self.remainder = b''
+        self.finish_message()
+        completed, self.completed = self.completed, []
+        return completed
+
+    def parse_line(self, line):
+        if self.string_parts is not None:
+            if not (self.string_closed and is_structural(line)):
+                self.continue_string(line)
+                return
+            self.finish_string()
+
+        if not line.startswith(' '):
+            if line.startswith(MESSAGE_KINDS):
+                self.finish_message()
+                kind = next(kind for kind in MESSAGE_KINDS if line.startswith(kind))
+                self.message = MonitorMessage(kind, dict(HEADER_FIELD_RE.findall(line)))
+                self.expected = EXPECTED_ARGUMENTS.get(self.message.member)
+            return  # Anything else at column 0 is not part of a message
+        if self.message is None:
+            return
+
+        # One split of the stripped line tells what it holds
+        value = line.lstrip(' ')
+        type_name, _, text = value.partition(' ')
+        if type_name == 'variant':
+            value = text.lstrip(' ')
+            type_name, _, text = value.partition(' ')
+        if type_name == 'string':
+            self.start_string(text)
+        elif type_name in INTEGER_TYPES:
+            try:
+                self.add_value(int(text))
+            except ValueError:
+                self.add_value(text)
+        elif value in CLOSE_CONTAINERS:
+            if self.containers:
+                container_type, items = self.containers.pop()
+                self.add_value(container_type(items))
+        elif value in OPEN_CONTAINERS:
+            self.containers.append((OPEN_CONTAINERS[value], []))
+        elif type_name == 'boolean':
+            self.add_value(text == 'true')
+        elif type_name == 'double':
+            self.add_value(float(text))
+        elif type_name == 'object' and text.startswith('path '):
+            self.start_string(text[len('path '):])
+        elif type_name == 'signature':
+            self.start_string(text)
+        elif value:
+            trace_line('Unrecognized dbus-monitor line: %s', line)
+
+    def start_string(self, text):
+        # text is everything after the type name, starting with the opening quote
+        self.string_parts = []
+        self.continue_string(text[1:])
+
+    def continue_string(self, text):
+        self.string_closed = text.endswith('"')
+        self.string_parts.append(text)
+        if self.string_closed and self.message_complete(extra=1):
+            # The last argument of a message with a known signature, no need
+            # to wait for the next line to know the string ended here
+            self.finish_string()
+
+    def finish_string(self):
+        text = self.string_parts[0] if len(self.string_parts) == 1 else '\n'.join(self.string_parts)
+        self.string_parts = None
+        self.add_value(text[:-1] if text.endswith('"') else text)
+
+    def add_value(self, value):
+        if self.containers:
+            self.containers[-1][1].append(value)
+            return
+        self.message.args.append(value)
+        if self.message_complete():
+            self.finish_message()
+
+    def message_complete(self, extra=0):
+        if self.expected is None or self.containers or self.message is None:
+            return False
+        return len(self.message.args) + extra == self.expected
+
+    def finish_message(self):
+        if self.string_parts is not None:
+            self.finish_string()
+        if self.message is None:
+            return
+        # Containers left open by a truncated message are closed as they are
+        while self.containers:
+            container_type, items = self.containers.pop()
+            self.add_value(container_type(items))
+            if self.message is None:
+                return
+        message, self.message = self.message, None
+        self.expected = None
+        self.completed.append(message)
+
+
+class DbusMonitorListener:
+    # Runs dbus-monitor as an asyncio subprocess and hands every parsed message
+    # to on_message. Output is read in large chunks as soon as it is available,
+    # and dbus-monitor is started again (after restart_delay, doubling up to
+    # max_restart_delay) whenever it exits. Cancelling listen() terminates it.
+    def __init__(self, bus_address='SESSION', restart_delay=1.0, max_restart_delay=30.0):
+        self.bus_address = bus_address
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+    def command(self):
+        command = ['dbus-monitor']
+        if self.bus_address and self.bus_address != 'SESSION':
+            command += ['--address', self.bus_address]
+        # Replies of the notification server are needed for the notification ids
+        return command + ["interface='org.freedesktop.Notifications'",
+                          "type='method_return',sender='org.freedesktop.Notifications'"]
+
+    async def listen(self, on_message, record=None):
+        delay = self.restart_delay
+        while True:
+            started = time.monotonic()
+            try:
+                process = await asyncio.create_subprocess_exec(*self.command(), stdout=asyncio.subprocess.PIPE)
+            except OSError as e:
+                logging.warning(f'Failed to start dbus-monitor: {e}')
+            else:
+                try:
+                    await self.read_messages(process, on_message, record)
+                finally:
+                    await self.stop_process(process)
+            # A dbus-monitor that ran for a while is restarted quickly again
+            if time.monotonic() - started > self.max_restart_delay:
+                delay = self.restart_delay
+            logging.warning(f'dbus-monitor exited, restarting it in {delay:.1f}s.')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_restart_delay)
+
+    async def read_messages(self, process, on_message, record=None):
+        parser = DbusMonitorParser()
+        while True:
+            data = await process.stdout.read(READ_SIZE)
+            parse_started = time.monotonic()
+            messages = parser.feed(data) if data else parser.close()
+            if record is not None and messages:
+                record('parse', time.monotonic() - parse_started)
+            for message in messages:
+                on_message(message)
+            if not data:
+                return  # End of output, dbus-monitor is gone
+
+    async def stop_process(self, process):
+        if process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=2)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import threading
+import collections
+
+# Rough speaking rate used to estimate how much speech a skipped duplicate saved
+CHARACTERS_PER_SECOND = 15
+
+
+def content_key(notification):
+    # Hash of the source and every entry; the separator keeps ['ab', 'c'] and
+    # ['a', 'bc'] apart
+    digest = hashlib.blake2b('\x1f'.join(notification.sequential_strings).encode('utf-8'), digest_size=16)
+    return digest.digest()
+
+
+class DedupIndex:
+    # Drops notifications that were already read: the same content seen within
+    # window_seconds (the window slides with every repeat, so an app that keeps
+    # re-emitting a notification is read once), or a replacement (replaces_id)
+    # that does not change the text of the notification it replaces; the
+    # original is known by the id the server gave it (record_id).
+    # Both lookups are dict operations, and the index never holds more than
+    # max_entries hashes.
+    def __init__(self, window_seconds=30, max_entries=1000):
+        self.window = window_seconds
+        self.max_entries = max(1, max_entries)
+        self.seen = collections.OrderedDict()  # {content key: last seen}
+        self.replaced = collections.OrderedDict()  # {notification id: content key}
+        self.spoken_characters = collections.OrderedDict()  # {content key: characters read for it}
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+        self.replaced_duplicates = 0
+        self.characters_saved = 0
+
+    def is_duplicate(self, notification):
+        key = content_key(notification)
+        notification.content_key = key
+        now = notification.received
+        with self.lock:
+            self.checked += 1
+            self._expire(now)
+            replaces_id = notification.replaces_id
+            unchanged_replacement = bool(replaces_id) and self.replaced.get(replaces_id) == key
+            duplicate = unchanged_replacement or key in self.seen
+            if replaces_id:
+                self._remember_id(replaces_id, key)
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+            if len(self.seen) > self.max_entries:
+                self.seen.popitem(last=False)
+            if duplicate:
+                self.duplicates += 1
+                if unchanged_replacement:
+                    self.replaced_duplicates += 1
+                self.characters_saved += self.spoken_characters.get(key, 0)
+        if duplicate:
+            logging.debug('Skipping duplicate notification from %s.', notification.source)
+        return duplicate
+
+    def record_id(self, notification_id, key):
+        # The server's id for a notification, from its reply to Notify, so
+        # the first replacement that does not change it is skipped as well
+        if key is None:
+            return
+        with self.lock:
+            self._remember_id(notification_id, key)
+
+    def _remember_id(self, notification_id, key):
+        # Called with self.lock held
+        self.replaced[notification_id] = key
+        self.replaced.move_to_end(notification_id)
+        if len(self.replaced) > self.max_entries:
+            self.replaced.popitem(last=False)
+
+    def _expire(self, now):
+        while self.seen:
+            last_seen = next(iter(self.seen.values()))
+            if now - last_seen <= self.window:
+                break
+            self.seen.popitem(last=False)
+
+    def record_spoken(self, key, characters):
+        # How much text the rules let through for this content, so a later
+        # duplicate can be counted as speech saved
+        if key is None:
+            return
+        with self.lock:
+            self.spoken_characters[key] = characters
+            self.spoken_characters.move_to_end(key)
+            if len(self.spoken_characters) > self.max_entries:
+                self.spoken_characters.popitem(last=False)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'checked': self.checked,
+                'duplicates': self.duplicates,
+                'replaced_duplicates': self.replaced_duplicates,
+                'entries': len(self.seen),
+                'speech_seconds_saved': self.characters_saved / CHARACTERS_PER_SECOND,
+            }
@@ -0,0 +1,58 @@
+import functools
+from langdetect import DetectorFactory, detect
+from langdetect.lang_detect_exception import LangDetectException
+
+# langdetect is random by default, the same text could be routed differently
+DetectorFactory.seed = 0
+
+# Share of letters that must be in one script to skip statistical detection
+SCRIPT_THRESHOLD = 0.8
+
+
+def script_counts(text):
+    # (Cyrillic letters, Latin letters) in text
+    cyrillic = latin = 0
+    for char in text:
+        if char < '\u0080':
+            if char.isalpha():
+                latin += 1
+        elif 'Ѐ' <= char <= 'ӿ':
+            cyrillic += 1
+        elif char.isalpha() and 'À' <= char <= 'ɏ':
+            latin += 1
+    return cyrillic, latin
+
+
+@functools.lru_cache(maxsize=4096)
+def detect_language(text):
+    # Statistical detection, memoized; None when langdetect finds no features
+    try:
+        return detect(text)
+    except LangDetectException:
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def route_language(text):
+    # Picks the TTS engine language, 'ru' or 'en'. Most texts are clearly in
+    # one script and are routed by counting letters; only mixed texts are
+    # passed to langdetect.
+    cyrillic, latin = script_counts(text)
+    letters = cyrillic + latin
+    if letters:
+        if cyrillic >= letters * SCRIPT_THRESHOLD:
+            return 'ru'
+        if latin >= letters * SCRIPT_THRESHOLD:
+            return 'en'
+    return 'ru' if detect_language(text) == 'ru' else 'en'
+
+
+def is_in_language(text, language):
+    # Used by 'is in language' rules. A text without a single letter of the
+    # language's script cannot be in it, which settles most checks for free.
+    cyrillic, latin = script_counts(text)
+    if language == 'ru' and not cyrillic:
+        return False
+    if language == 'en' and not latin:
+        return False
+    return detect_language(text) == language
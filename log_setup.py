@@ -0,0 +1,91 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DEFAULT_LOGGING = {
+    'level': 'INFO',
+    'file': os.path.join('logs', 'debug.log'),
+    'max_bytes': 5 * 1024 * 1024,
+    'backup_count': 3,
+    'console': True,
+    'trace_max_per_second': 10,
+}
+
+listener = None
+trace_max_per_second = DEFAULT_LOGGING['trace_max_per_second']
+
+
+def configure_logging(logging_settings=None, base_dir=None):
+    # Log records are put on a queue by the thread that logs them and written
+    # to the rotating file and the console by a listener thread, so file and
+    # terminal I/O never hold up notification handling. Only the first call
+    # does anything (the GUI configures logging before importing the reader).
+    # Handlers found on the root logger are replaced: a module-level
+    # logging.debug() before this point (load_settings() logs) installs a
+    # default stderr handler.
+    global listener, trace_max_per_second
+    if listener is not None:
+        return
+    root = logging.getLogger('')
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    config = dict(DEFAULT_LOGGING, **(logging_settings or {}))
+    trace_max_per_second = config['trace_max_per_second']
+    level = logging.getLevelName(str(config['level']).upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = []
+    if config['file']:
+        log_path = config['file']
+        if base_dir and not os.path.isabs(log_path):
+            log_path = os.path.join(base_dir, log_path)
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(log_path, maxBytes=config['max_bytes'],
+                                                             backupCount=config['backup_count'], encoding='utf-8'))
+    if config['console']:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    # Records still queued at exit are written before the process ends
+    atexit.register(listener.stop)
+
+
+class SampledTrace:
+    # DEBUG tracing for things that happen per line or per message. Costs one
+    # level check when DEBUG is off; with DEBUG on, at most
+    # trace_max_per_second records get through each second and the next one
+    # that does tells how many were left out.
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+        self.window_started = 0.0
+        self.in_window = 0
+        self.suppressed = 0
+
+    def __call__(self, message, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        now = time.monotonic()
+        if now - self.window_started >= 1.0:
+            self.window_started = now
+            self.in_window = 0
+        if self.in_window >= trace_max_per_second:
+            self.suppressed += 1
+            return
+        self.in_window += 1
+        if self.suppressed:
+            message += ' (%d more not logged)'
+            args += (self.suppressed,)
+            self.suppressed = 0
+        self.logger.debug(message, *args)
@@ -0,0 +1,287 @@
+import os
+import bisect
+import logging
+import ipaddress
+import threading
+import socketserver
+import http.server
+
+# Upper bounds in seconds; covers a sub-millisecond rule check as well as a
+# long clip being played
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# A metric with more label sets than this (e.g. many notification sources)
+# counts the rest under 'other'
+MAX_LABEL_SETS = 200
+OTHER = 'other'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}  # {label values: value}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        # Called with self.lock held
+        labels = tuple(labels)
+        if labels in self.values or len(self.values) < MAX_LABEL_SETS:
+            return labels
+        return (OTHER,) * len(self.label_names)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            key = self.key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, labels=()):
+        # For totals counted elsewhere (queue drops, cache hits), copied in at
+        # collection time
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def get(self, labels=()):
+        with self.lock:
+            return self.values.get(tuple(labels), 0)
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f'{self.name}{format_labels(self.label_names, labels)} {format_value(value)}'
+                                for labels, value in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+
+class HistogramValue:
+    def __init__(self, bucket_count):
+        self.counts = [0] * (bucket_count + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            key = self.key(labels)
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = HistogramValue(len(self.buckets))
+            histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+            histogram.count += 1
+            histogram.sum += value
+
+    def summary(self, labels=()):
+        # {'count', 'avg', 'p50', 'p95'} for the stats view. Quantiles are
+        # estimated from the buckets the way Prometheus' histogram_quantile()
+        # does, by linear interpolation within the bucket.
+        with self.lock:
+            histogram = self.values.get(tuple(labels))
+            if histogram is None or not histogram.count:
+                return None
+            counts = list(histogram.counts)
+            count, total = histogram.count, histogram.sum
+        return {'count': count, 'avg': total / count,
+                'p50': self.quantile(counts, count, 0.5), 'p95': self.quantile(counts, count, 0.95)}
+
+    def quantile(self, counts, count, q):
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]  # Beyond the last bucket, its bound is all we know
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return None
+
+    def label_sets(self):
+        with self.lock:
+            return sorted(self.values)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = sorted((labels, list(h.counts), h.count, h.sum) for labels, h in self.values.items())
+        for labels, counts, count, total in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(self.label_names, labels, [('le', format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    # Every metric of the process, by name. Recording is a dict update under a
+    # per-metric lock; values kept elsewhere (queue depths, cache counts) are
+    # copied in by the on_collect hooks right before rendering.
+    def __init__(self):
+        self.metrics = {}
+        self.collect_hooks = []
+        self.lock = threading.Lock()
+
+    def _get(self, metric_class, name, help_text, label_names, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, help_text, label_names, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._get(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._get(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, label_names, buckets=buckets)
+
+    def on_collect(self, hook):
+        with self.lock:
+            self.collect_hooks.append(hook)
+
+    def remove_on_collect(self, hook):
+        with self.lock:
+            if hook in self.collect_hooks:
+                self.collect_hooks.remove(hook)
+
+    def collect(self):
+        with self.lock:
+            hooks = list(self.collect_hooks)
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                logging.debug('Metrics collection hook failed: %s', e)
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        self.collect()
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+
+class MetricsHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class MetricsUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    # Serves the registry at /metrics, either over HTTP on a loopback address
+    # (curl http://127.0.0.1:9477/metrics) or, with unix_socket set, over HTTP
+    # on that socket (curl --unix-socket <path> http://localhost/metrics).
+    # Nothing is ever bound to a non-local address.
+    def __init__(self, registry, host='127.0.0.1', port=9477, unix_socket=None):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.server is not None:
+            return
+        try:
+            if self.unix_socket:
+                if os.path.exists(self.unix_socket):
+                    os.unlink(self.unix_socket)  # Left over by a reader that did not exit cleanly
+                self.server = MetricsUnixServer(self.unix_socket, MetricsRequestHandler)
+                os.chmod(self.unix_socket, 0o600)
+                where = self.unix_socket
+            else:
+                host = self.host if self.host == 'localhost' or ipaddress.ip_address(self.host).is_loopback else None
+                if host is None:
+                    logging.warning(f'Metrics address {self.host} is not a loopback address, using 127.0.0.1.')
+                    host = '127.0.0.1'
+                self.server = MetricsHTTPServer((host, self.port), MetricsRequestHandler)
+                where = f'http://{host}:{self.server.server_address[1]}/metrics'
+        except (OSError, ValueError) as e:
+            logging.warning(f'Failed to start the metrics endpoint: {e}')
+            self.server = None
+            return
+        self.server.registry = self.registry
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+        logging.info(f'Serving metrics on {where}')
+
+    def stop(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        server.shutdown()
+        server.server_close()
+        self.thread = None
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
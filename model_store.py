@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import urllib.request
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+MANIFEST_NAME = 'manifest.json'
+SILERO_URL = 'https://models.silero.ai/models/tts/{language}/{model_id}.pt'
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelStore:
+    # Local, versioned copies of the TTS models, so nothing is fetched from
+    # the network at startup. manifest.json lists every model with its
+    # version and the sha256 of each of its files:
+    #
+    #   {"silero/ru/v4_ru": {"version": "v4_ru", "path": "silero/ru",
+    #                        "files": {"v4_ru.pt": "<sha256>"}}, ...}
+    def __init__(self, models_dir=MODELS_DIR):
+        self.models_dir = models_dir
+        self.manifest_path = os.path.join(models_dir, MANIFEST_NAME)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning(f'Failed to read model manifest {self.manifest_path}: {e}')
+            return {}
+
+    def save_manifest(self):
+        os.makedirs(self.models_dir, exist_ok=True)
+        temp_path = f'{self.manifest_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def model_dir(self, key):
+        entry = self.manifest.get(key)
+        if entry is None:
+            return None
+        return os.path.join(self.models_dir, entry['path'])
+
+    def verified_path(self, key, file_name=None):
+        # Path of the model (or one of its files) if it is in the store and
+        # every file matches its checksum, otherwise None
+        entry = self.manifest.get(key)
+        if entry is None:
+            return None
+        model_dir = os.path.join(self.models_dir, entry['path'])
+        for name, expected in entry['files'].items():
+            path = os.path.join(model_dir, name)
+            if not os.path.exists(path):
+                logging.warning(f'Model file missing from the store: {path}')
+                return None
+            if sha256_of(path) != expected:
+                logging.warning(f'Checksum mismatch for model file {path}')
+                return None
+        return os.path.join(model_dir, file_name) if file_name else model_dir
+
+    def add(self, key, version, relative_dir):
+        # Records every file under relative_dir as the current version of key
+        model_dir = os.path.join(self.models_dir, relative_dir)
+        files = {}
+        for root, _, names in os.walk(model_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, model_dir)] = sha256_of(path)
+        self.manifest[key] = {'version': version, 'path': relative_dir, 'files': files}
+        self.save_manifest()
+
+
+def silero_key(language, model_id):
+    return f'silero/{language}/{model_id}'
+
+
+def vits_key(model_name):
+    return f'coqui/{model_name}'
+
+
+def coqui_home(models_dir=MODELS_DIR):
+    # Coqui TTS keeps its downloads under TTS_HOME; pointing it into the store
+    # lets Coqui find the model there instead of downloading it
+    return os.path.join(models_dir, 'coqui')
+
+
+def fetch_silero(store, language, model_id):
+    relative_dir = os.path.join('silero', language)
+    target_dir = os.path.join(store.models_dir, relative_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    target = os.path.join(target_dir, f'{model_id}.pt')
+    url = SILERO_URL.format(language=language, model_id=model_id)
+    print(f'Downloading {url}')
+    with urllib.request.urlopen(url) as response, open(f'{target}.tmp', 'wb') as f:
+        shutil.copyfileobj(response, f)
+    os.replace(f'{target}.tmp', target)
+    store.add(silero_key(language, model_id), model_id, relative_dir)
+
+
+def fetch_vits(store, model_name):
+    os.environ['TTS_HOME'] = coqui_home(store.models_dir)
+    from TTS.utils.manage import ModelManager
+    print(f'Downloading {model_name}')
+    model_path, _, _ = ModelManager(progress_bar=True).download_model(model_name)
+    model_dir = model_path if os.path.isdir(model_path) else os.path.dirname(model_path)
+    relative_dir = os.path.relpath(model_dir, store.models_dir)
+    store.add(vits_key(model_name), model_name.split('/')[-1], relative_dir)
+
+
+def fetch_all(store):
+    # Downloads every model named in the settings into the store
+    from settings import load_settings
+    for language, engine_settings in load_settings()['tts'].items():
+        if not isinstance(engine_settings, dict):
+            continue
+        if engine_settings.get('engine') == 'silero':
+            fetch_silero(store, language, engine_settings.get('model_id', 'v4_ru'))
+        elif engine_settings.get('engine') == 'vits':
+            fetch_vits(store, engine_settings.get('model_name', 'tts_models/en/vctk/vits'))
+
+
+if __name__ == '__main__':
+    # python model_store.py fetch   - download the configured models (needs network once)
+    # python model_store.py verify  - check the checksums of the stored models
+    command = sys.argv[1] if len(sys.argv) > 1 else 'verify'
+    store = ModelStore()
+    if command == 'fetch':
+        fetch_all(store)
+    for key in sorted(store.manifest):
+        status = 'ok' if store.verified_path(key) else 'FAILED'
+        print(f'{key} ({store.manifest[key]["version"]}): {status}')
@@ -1,335 +1,754 @@
+import time
+IMPORT_STARTED = time.monotonic()
 import os
-import re
-import subprocess
-import tempfile
-import torch
-import torchaudio
+import asyncio
+import contextlib
+import threading
 import json
 import sys
+import signal
+import argparse
 import logging
-logger = logging.getLogger('')
-if not logger.hasHandlers():
-    # Determine the directory where this script resides
-    current_script_path = os.path.dirname(os.path.abspath(__file__))
-    
-    # Create a 'logs' directory if it doesn't exist
-    logs_dir_path = os.path.join(current_script_path, 'logs')
-    os.makedirs(logs_dir_path, exist_ok=True)
-    
-    # Create a log file within that directory
-    log_file_path = os.path.join(logs_dir_path, 'debug.log')
-    
-    # Configure logging
-    logging.basicConfig(filename=log_file_path, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-    console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG)
-    logger.addHandler(console)
-
-from omegaconf import OmegaConf
-from langdetect import detect
-from scipy.io.wavfile import write
-DEFAULT_SOURCE = 'Default - all notifications'
+from settings import load_settings, DEFAULT_SOURCE
+from log_setup import configure_logging, SampledTrace
+# Records go through a queue to a rotating file and the console, at the level
+# set in settings.json ("logging": {"level": "INFO"})
+configure_logging(load_settings()['logging'], os.path.dirname(os.path.abspath(__file__)))
+
+from lang_detect import route_language
+from tts_engines import create_engines, split_into_chunks, registry as tts_registry
+from model_store import ModelStore
+from audio_output import create_audio_output
+from audio_cache import AudioCache
+from rule_store import RuleStore, RuleSnapshot, thaw
+from dedup import DedupIndex
+from pipeline import SpeechPipeline, Utterance, AudioClip, STAGES, STAGE_SECONDS
+from dbus_listener import NativeNotificationListener, NotificationAssembler, native_listener_available
+from dbus_monitor import DbusMonitorListener
+from metrics import registry as metrics_registry, MetricsServer
+from control import ControlServer, ControlError, socket_path
+trace_message = SampledTrace('noti_reader.dbus')
+
+NOTIFICATIONS_SEEN = metrics_registry.counter('noti_reader_notifications_seen_total',
+                                              'Notifications received', ['source'])
+NOTIFICATIONS_DUPLICATE = metrics_registry.counter('noti_reader_notifications_duplicate_total',
+                                                   'Notifications skipped as repeats', ['source'])
+NOTIFICATIONS_READ = metrics_registry.counter('noti_reader_notifications_read_total',
+                                              'Notifications with text left to read after the rules', ['source'])
+NOTIFICATIONS_FILTERED = metrics_registry.counter('noti_reader_notifications_filtered_total',
+                                                  'Notifications the rules left nothing to read in', ['source'])
+SYNTHESIS_RTF = metrics_registry.histogram('noti_reader_tts_real_time_factor',
+                                           'Seconds of synthesis per second of speech', ['language', 'engine'],
+                                           buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0))
+QUEUE_DEPTH = metrics_registry.gauge('noti_reader_queue_depth', 'Items waiting in each pipeline queue', ['queue'])
+QUEUE_DROPPED = metrics_registry.counter('noti_reader_queue_dropped_total',
+                                         'Items dropped by the backpressure policy', ['queue'])
+QUEUE_COALESCED = metrics_registry.counter('noti_reader_queue_coalesced_total',
+                                           'Items merged into burst summaries', ['queue'])
+SCHEDULER_EXPIRED = metrics_registry.counter('noti_reader_utterances_expired_total',
+                                             'Utterances dropped unspoken after waiting too long')
+AUDIO_CACHE = metrics_registry.counter('noti_reader_audio_cache_lookups_total',
+                                       'Audio cache lookups by result', ['result'])
+MODEL_BYTES = metrics_registry.gauge('noti_reader_tts_model_bytes', 'Memory used by the loaded TTS models')
+
+
+class StartupReport:
+    # Where the time from importing this module to "ready" goes
+    def __init__(self):
+        self.phases = [('imports', time.monotonic() - IMPORT_STARTED)]
+        self.ready_after = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - started))
+
+    def ready(self):
+        self.ready_after = time.monotonic() - IMPORT_STARTED
+        phases = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.phases)
+        logging.info(f'Ready {self.ready_after:.2f}s after import: {phases}')
+
+    def as_dict(self):
+        return {'phases': dict(self.phases), 'ready_after': self.ready_after}
 
 
 class NotificationReader:
     def __init__(self, callback=None):
-        # Load Silero model for Russian TTS
-        self.language = 'ru'
-        self.model_id = 'v4_ru'
-        self.sample_rate = 48000
-        self.speaker = 'aidar'
-        self.device = torch.device('cpu')
-        self.model, _ = torch.hub.load(repo_or_dir='snakers4/silero-models',
-                                       model='silero_tts',
-                                       language=self.language,
-                                       speaker=self.model_id)
-        self.model.to(self.device)
-        logging.debug(f'TTS initialized with language: {self.language} and model ID: {self.model_id}')
+        self.startup = StartupReport()
+        with self.startup.phase('settings'):
+            self.settings = load_settings()
+        # Models are loaded on first use (or by warm_up() when the reader
+        # starts) from the local model store, and are shared by every reader
+        # in the process
+        models_settings = self.settings['models']
+        self.model_store = ModelStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), models_settings['dir']))
+        self.engines = create_engines(self.settings['tts'], self.model_store, models_settings['allow_download'],
+                                      self.settings['inference'])
+        self.time_to_first_audio_target = self.settings['tts']['time_to_first_audio_target']
+        self.last_time_to_first_audio = None
+        cache_settings = self.settings['cache']
+        disk_dir = None
+        if cache_settings['disk']:
+            disk_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), cache_settings['disk_dir'])
+        self.audio_cache = AudioCache(cache_settings['max_bytes'], disk_dir, cache_settings['disk_max_bytes'])
+        self.audio_output = create_audio_output(self.settings['audio'])
+        dedup_settings = self.settings['dedup']
+        self.dedup = None
+        if dedup_settings['enabled']:
+            self.dedup = DedupIndex(dedup_settings['window_seconds'], dedup_settings['max_entries'])
+        self.pipeline = SpeechPipeline(self.filter_notification, self.synthesize_batch, self.play_clip,
+                                       self.settings['pipeline'], self.settings['scheduler'],
+                                       can_batch=self.engine_supports_batching)
         # Database for notification sources and their corresponding rules
         current_script_path = os.path.dirname(os.path.abspath(__file__))
         self.current_source = ''
         self.advanced_rules_file_path = os.path.join(current_script_path, 'advanced_rules.json')
         self.json_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'source_rules.json')  # Absolute path
         print(f"DEBUG: JSON Path: {self.json_path}")  # Debug line
-        self.advanced_rules = {}
-        self.load_rules()
-        self.load_advanced_rules()
+        # All rules live in one immutable snapshot, see publish_rules()
+        self.rules = RuleSnapshot(0, {DEFAULT_SOURCE: [0, 1]}, {})
+        self.publish_lock = threading.RLock()
+        # Edits are written a moment later in one go, and changes made to the
+        # files while the reader runs are picked up without a restart
+        rules_settings = self.settings['rules']
+        self.rule_store = RuleStore([self.json_path, self.advanced_rules_file_path], self.reload_rules,
+                                    rules_settings['save_delay_seconds'], rules_settings['poll_interval_seconds'])
+        with self.startup.phase('rules'):
+            self.load_rules()
+            self.load_advanced_rules()
         logging.debug("Application is loaded and ready")
-
-        # List to hold last N notifications for deduplication
-        self.recent_notifications = []
-        self.max_recent_notifications = 10
         self.running = False
+        self.loop = None
+        self.stopped = None
+        self.is_shut_down = False
+        self.shut_down_lock = threading.Lock()
         self.callback = callback
+        # Notifications are read as soon as their Notify call is complete;
+        # closing or replacing one cuts its speech short
+        self.assembler = NotificationAssembler(self.submit_notification, self.on_notification_closed,
+                                               self.on_notification_id)
+        self.current_clip = None
+        # Counters and histograms are recorded as things happen; queue depths
+        # and the other totals kept elsewhere are copied in when scraped
+        metrics_registry.on_collect(self.collect_metrics)
+        metrics_settings = self.settings['metrics']
+        self.metrics_server = None
+        if metrics_settings['enabled']:
+            self.metrics_server = MetricsServer(metrics_registry, metrics_settings['host'], metrics_settings['port'],
+                                                metrics_settings['unix_socket'] or None)
         
+    # Read-only views of the current snapshot; use update_rules(),
+    # set_advanced_rule() and the other methods below to change rules
+    @property
+    def source_rules(self):
+        return self.rules.source_rules
+
+    @property
+    def advanced_rules(self):
+        return self.rules.advanced_rules
+
+    @property
+    def compiled_rules(self):
+        return self.rules.compiled_rules
+
+    def publish_rules(self, source_rules=None, advanced_rules=None, save=True):
+        # Builds the next snapshot (rules compiled included) and makes it
+        # current with one assignment. Notifications being filtered keep the
+        # snapshot they started with. Editors hold publish_lock from reading
+        # the current rules to publishing, readers never lock.
+        with self.publish_lock:
+            self.rules = self.rules.replace(source_rules, advanced_rules)
+            logging.debug("Published rules version %d.", self.rules.version)
+        if save and source_rules is not None:
+            self.rule_store.save(self.json_path, lambda: thaw(self.rules.source_rules))
+        if save and advanced_rules is not None:
+            self.rule_store.save(self.advanced_rules_file_path, lambda: thaw(self.rules.advanced_rules))
+
     def load_rules(self):
         try:
             with open(self.json_path, 'r') as f:
-                self.source_rules = json.load(f)
-                if DEFAULT_SOURCE not in self.source_rules:
-                    self.source_rules[DEFAULT_SOURCE] = [0, 1]  # Defaults to reading the first two entries
-                    self.update_rules({})
+                source_rules = json.load(f)
+            if DEFAULT_SOURCE in source_rules:
+                self.publish_rules(source_rules=source_rules, save=False)
+            else:
+                source_rules[DEFAULT_SOURCE] = [0, 1]  # Defaults to reading the first two entries
+                self.publish_rules(source_rules=source_rules)
         except FileNotFoundError:
-            self.source_rules = {DEFAULT_SOURCE: [0, 1]}  # Defaults to reading the first two entries
+            self.publish_rules(source_rules={DEFAULT_SOURCE: [0, 1]}, save=False)  # Defaults to reading the first two entries
             logging.debug("source_rules.json not found, initializing with default rules.")
 
     def update_rules(self, new_rules):
-        # Prevent deletion of the default entry
-        if DEFAULT_SOURCE in self.source_rules and DEFAULT_SOURCE not in new_rules:
-            new_rules[DEFAULT_SOURCE] = self.source_rules[DEFAULT_SOURCE]
-        
-        self.source_rules.update(new_rules)
-        with open(self.json_path, 'w') as f:
-            json.dump(self.source_rules, f)
-        logging.debug(f"Updated rules saved to {self.json_path}")
+        with self.publish_lock:
+            source_rules = thaw(self.rules.source_rules)
+            source_rules.update(new_rules)
+            # Prevent deletion of the default entry
+            if DEFAULT_SOURCE not in source_rules:
+                source_rules[DEFAULT_SOURCE] = [0, 1]
+            self.publish_rules(source_rules=source_rules)
+        logging.debug(f"Updated rules will be saved to {self.json_path}")
+
+    def delete_source_rule(self, source):
+        if source == DEFAULT_SOURCE:
+            return
+        with self.publish_lock:
+            source_rules = thaw(self.rules.source_rules)
+            if source_rules.pop(source, None) is not None:
+                self.publish_rules(source_rules=source_rules)
+
+    def reload_rules(self, path):
+        # Called by the rule store when a rule file was changed by someone else
+        if path == os.path.abspath(self.json_path):
+            self.load_rules()
+        else:
+            self.load_advanced_rules()
+        logging.info(f'Reloaded rules from {path}')
 
     def update_advanced_rules(self, advanced_rules):
-        self.advanced_rules = advanced_rules     
-        self.save_advanced_rules()  
+        self.publish_rules(advanced_rules=advanced_rules)
 
     def update_single_advanced_rule(self, source, advanced_rule):
-        self.advanced_rules[source] = advanced_rule
-        self.save_advanced_rules()
-
-    def apply_advanced_rule(self, sequential_strings, source, actions):
-        logging.debug("Entering apply_advanced_rule.")
-
-        if source not in self.advanced_rules:
-            logging.debug(f"No advanced rules for source {source}.")
+        with self.publish_lock:
+            advanced_rules = thaw(self.rules.advanced_rules)
+            advanced_rules[source] = advanced_rule
+            self.publish_rules(advanced_rules=advanced_rules)
+
+    def set_advanced_rule(self, source, entry_index, rule):
+        # Adds the rule for entry_index of source, or replaces the existing one
+        with self.publish_lock:
+            advanced_rules = thaw(self.rules.advanced_rules)
+            rule_list = advanced_rules.get(source, [])
+            if not isinstance(rule_list, list):
+                # Older files kept {entry_index: rule} per source
+                rule_list = [{"entry_index": int(k), "rule": v} for k, v in rule_list.items()]
+            rule_list = [r for r in rule_list if r["entry_index"] != entry_index]
+            rule_list.append({"entry_index": entry_index, "rule": rule})
+            advanced_rules[source] = rule_list
+            self.publish_rules(advanced_rules=advanced_rules)
+
+    def delete_advanced_rule(self, source, entry_index):
+        with self.publish_lock:
+            advanced_rules = thaw(self.rules.advanced_rules)
+            rule_list = advanced_rules.get(source)
+            if not isinstance(rule_list, list):
+                return False
+            remaining = [r for r in rule_list if r["entry_index"] != entry_index]
+            if len(remaining) == len(rule_list):
+                return False
+            if remaining:
+                advanced_rules[source] = remaining
+            else:
+                # If the list becomes empty, remove the source entry
+                del advanced_rules[source]
+            self.publish_rules(advanced_rules=advanced_rules)
+            return True
+
+    def apply_advanced_rule(self, sequential_strings, source, actions, rules=None):
+        # Rules are compiled when a snapshot is published, so the notification
+        # loop does no parsing at all
+        source_rules = (rules or self.rules).compiled_rules.get(source)
+        if source_rules is None:
+            logging.debug("No advanced rules for source %s.", source)
             return  # No rules matched
 
-        logging.debug(f"Advanced rules exist for source {source}. Rules: {self.advanced_rules[source]}")
-
-        for advanced_rule_entry in self.advanced_rules[source]:
-            entry_index = advanced_rule_entry["entry_index"]
-            advanced_rule = advanced_rule_entry["rule"]
-
-            logging.debug(f"Processing advanced_rule_entry {advanced_rule_entry}")
-
-            if entry_index < len(sequential_strings):
-                logging.debug(f"entry_index: {entry_index}, len(sequential_strings): {len(sequential_strings)}")
-                text_to_check = sequential_strings[entry_index]
-                logging.debug(f"Checking text {text_to_check} for advanced rules.")
-
-                if_rule = advanced_rule.get('if', {})
-                condition = if_rule.get('condition', '')
-                logging.debug(f"Condition from advanced rule: {condition}")
-
-                value = if_rule.get('value', '')
-                match = False
-
-                if condition == 'contains words/symbols':
-                    if advanced_rule.get('use_regex', False):
-                        match = re.search(value, text_to_check) is not None
-                    else:
-                        quoted_terms = re.findall(r'"[^"]+"', value)
-                        unquoted_terms = re.findall(r'\b\w+\b', re.sub(r'"[^"]+"', '', value))
-                        terms = quoted_terms + unquoted_terms
-                        operators = re.findall(r'AND|OR', value)
-
-                        if not operators:
-                            operators = ['AND'] * (len(terms) - 1)
-
-                        grouped_results = []
-                        for i, term in enumerate(terms):
-                            if term.startswith('"') and term.endswith('"'):
-                                term = term.strip('"')
-                                grouped_results.append(term in text_to_check)
-                            else:
-                                grouped_results.append(term in text_to_check.split())
-
-                        match = any(grouped_results) if 'OR' in operators else all(grouped_results)
-
-                elif condition == 'does not contain words/symbols':
-                    if advanced_rule.get('use_regex', False):
-                        match = re.search(value, text_to_check) is None
-                    else:
-                        quoted_terms = re.findall(r'"[^"]+"', value)
-                        unquoted_terms = re.findall(r'\b\w+\b', re.sub(r'"[^"]+"', '', value))
-                        terms = quoted_terms + unquoted_terms
-                        operators = re.findall(r'AND|OR', value)
-
-                        if not operators:
-                            operators = ['AND'] * (len(terms) - 1)
-
-                        grouped_results = []
-                        for i, term in enumerate(terms):
-                            if term.startswith('"') and term.endswith('"'):
-                                term = term.strip('"')
-                                grouped_results.append(term not in text_to_check)
-                            else:
-                                grouped_results.append(term not in text_to_check.split())
-
-                        match = any(grouped_results) if 'OR' in operators else all(grouped_results)
-
-                elif condition == 'is in language':
-                    detected_lang = detect(text_to_check)
-                    match = detected_lang == value
-
-                elif condition == 'has this amount of words':
-                    match = len(text_to_check.split()) == int(value)
-
-                if match:
-                    logging.debug(f"Condition matched. Processing actions.")
-                    then_rule = advanced_rule.get('then', {})
-                    action = then_rule.get('action', '')
-                    target_entry_str = then_rule.get('entry', str(entry_index))
-                    target_entry_index = int(re.search(r'\d+', target_entry_str).group()) - 1 if re.search(r'\d+', target_entry_str) else entry_index
-
-                    if action in ['read', 'do not read']:
-                        if target_entry_index < len(actions):
-                            actions[target_entry_index] = action
-                    elif action == 'read certain words':
-                        replacement_words = then_rule.get('value', '')
-                        if target_entry_index < len(sequential_strings):
-                            sequential_strings[target_entry_index] = replacement_words
-                            actions[target_entry_index] = 'read'
-                else:
-                    logging.debug(f"Condition not matched. Skipping actions.")
-
-        return actions
+        return source_rules.apply(sequential_strings, actions)
+
+    def warm_up(self):
+        for lang, engine in self.engines.items():
+            with self.startup.phase(f'{lang} model'):
+                engine.load()
+        if self.startup.ready_after is None:
+            self.startup.ready()
+        logging.debug(f'TTS models ready: {tts_registry.get_stats()}')
 
     def start(self):
+        # Blocking wrapper around the asyncio core, for NotificationThread and
+        # __main__: returns once stop() was called (from any thread)
         self.running = True
-        self.run()
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        # The event loop runs the notification source; filtering, synthesis and
+        # playback run on the pipeline's worker threads, so the loop never
+        # waits for a model
+        self.stopped = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        if not self.running:
+            return  # stop() came first
+        with self.shut_down_lock:
+            self.is_shut_down = False
+        if self.settings['rules']['watch']:
+            self.rule_store.watch()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        source = asyncio.ensure_future(self.warm_up_and_run())
+        stop_requested = asyncio.ensure_future(self.stopped.wait())
+        try:
+            await asyncio.wait({source, stop_requested}, return_when=asyncio.FIRST_COMPLETED)
+            if source.done() and not source.cancelled() and source.exception() is not None:
+                logging.error(f'Notification source failed: {source.exception()}')
+        finally:
+            # Cancelling the source closes the D-Bus connection or terminates
+            # dbus-monitor before this returns
+            for task in (source, stop_requested):
+                task.cancel()
+            await asyncio.gather(source, stop_requested, return_exceptions=True)
+            self.shut_down()
+            # The pipeline may have started after stop() shut down, if warm-up
+            # was finishing just then; stopping a stopped pipeline is cheap
+            self.pipeline.stop(interrupt=self.audio_output.close)
+            self.loop = None
+
+    async def warm_up_and_run(self):
+        await self.loop.run_in_executor(None, self.warm_up)
+        if not self.running:
+            return  # Stopped while the models were loading
+        self.pipeline.start()
+        await self.run()
 
     def stop(self):
+        # Safe to call from any thread. Queued speech is dropped, playback is
+        # cut off and audio still being synthesized is thrown away.
         self.running = False
+        loop, stopped = self.loop, self.stopped
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(stopped.set)
+            except RuntimeError:
+                pass  # The loop has just finished
+        self.shut_down()
+
+    def shut_down(self):
+        # Called by stop() and again when run_async() finishes; only the
+        # first call after a run does anything
+        self.running = False
+        with self.shut_down_lock:
+            if self.is_shut_down:
+                return
+            self.is_shut_down = True
+        self.rule_store.stop()
+        self.pipeline.stop(interrupt=self.audio_output.close)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+    def get_stats(self):
+        # Queue depths, drop counts and per-stage latency of the speech
+        # pipeline, hit/miss/eviction counts of the audio cache and the memory
+        # used by the loaded TTS models, and what the dedup index skipped
+        stats = self.pipeline.get_stats()
+        if self.dedup is not None:
+            stats['dedup'] = self.dedup.get_stats()
+        stats['audio_cache'] = self.audio_cache.get_stats()
+        stats['tts_models'] = tts_registry.get_stats()
+        stats['startup'] = self.startup.as_dict()
+        return stats
+
+    def collect_metrics(self):
+        stats = self.pipeline.get_stats()
+        for name, queue in stats['queues'].items():
+            QUEUE_DEPTH.set(queue['depth'], (name,))
+            QUEUE_DROPPED.set(queue['dropped'], (name,))
+            QUEUE_COALESCED.set(queue['coalesced'], (name,))
+        SCHEDULER_EXPIRED.set(stats['scheduler']['expired'])
+        cache = self.audio_cache.get_stats()
+        for result in ('hits', 'disk_hits', 'misses'):
+            AUDIO_CACHE.set(cache[result], (result,))
+        MODEL_BYTES.set(tts_registry.get_stats()['total_bytes'])
+
+    def get_metrics_summary(self):
+        # The numbers behind the stats view, plain and JSON serializable
+        queues = self.pipeline.get_stats()['queues']
+        return {
+            'notifications': {'seen': NOTIFICATIONS_SEEN.total(), 'read': NOTIFICATIONS_READ.total(),
+                              'filtered': NOTIFICATIONS_FILTERED.total(),
+                              'duplicates': NOTIFICATIONS_DUPLICATE.total()},
+            'queues': {name: queue['depth'] for name, queue in queues.items()},
+            'dropped': sum(queue['dropped'] for queue in queues.values()),
+            'stages': {stage: STAGE_SECONDS.summary((stage,)) for stage in STAGES},
+            'rtf': {f'{lang} {engine}': SYNTHESIS_RTF.summary((lang, engine))['avg']
+                    for lang, engine in SYNTHESIS_RTF.label_sets()},
+        }
+
+    def record_synthesis(self, engine, lang, seconds, samples):
+        if samples:
+            SYNTHESIS_RTF.observe(seconds * engine.sample_rate / samples, (lang, engine.model_key[0]))
 
     def read_text(self, text, lang):
-        if self.callback:
-            self.callback(text)
-        logging.debug(f'Trying to read text: "{text}" in language: "{lang}"')
-        if self.callback:
-            self.callback(text)
-        if lang == 'en':
-            with tempfile.NamedTemporaryFile('w', delete=False) as f:
-                f.write(text)
-                f.flush()
-                command = f'cat {f.name} | tts --text "{text}" --model_name "tts_models/en/vctk/vits" --speaker_idx p230 --out_path /tmp/tts_output.wav  --use_cuda USE_CUDA'
-                logging.debug(f'Executing TTS command: {command}')
-                subprocess.run(command, shell=True)
-                play_command = 'aplay /tmp/tts_output.wav'
-                logging.debug(f'Executing play command: {play_command}')
-                subprocess.run(play_command, shell=True)
-        elif lang == 'ru':
-            audio = self.model.apply_tts(text=text,
-                                         speaker=self.speaker,
-                                         sample_rate=self.sample_rate)
-            audio = audio.squeeze().numpy()
-            write('/tmp/tts_output.wav', self.sample_rate, audio)
-            play_command = 'aplay /tmp/tts_output.wav'
-            subprocess.run(play_command, shell=True)
-
-    def run(self):
-        # Intercept a notification
-        command = "dbus-monitor \"interface='org.freedesktop.Notifications'\""
+        # Synthesizes and plays text right away, bypassing the pipeline queues
+        utterance = Utterance(text, lang, self.current_source, time.monotonic())
+        clips = self.synthesize_utterance(utterance)
+        while True:
+            started = time.monotonic()
+            clip = next(clips, None)
+            if clip is None:
+                break
+            self.pipeline.record('synthesis', time.monotonic() - started)
+            started = time.monotonic()
+            self.play_clip(clip)
+            self.pipeline.record('playback', time.monotonic() - started)
+
+    def split_utterance(self, utterance):
+        if self.settings['tts']['streaming']:
+            return split_into_chunks(utterance.text, self.settings['tts']['chunk_max_chars'])
+        return [utterance.text]
+
+    def synthesize_utterance(self, utterance):
+        logging.debug('Trying to read text: "%s" in language: "%s"', utterance.text, utterance.lang)
+        engine = self.engines.get(utterance.lang)
+        if engine is None:
+            logging.debug('No TTS engine configured for language: %s', utterance.lang)
+            return
+        chunks = self.split_utterance(utterance)
+        engine.load()
+        started = time.monotonic()
+        # Each chunk is handed to playback as soon as it is ready, so chunk N
+        # plays while chunk N + 1 is being synthesized
+        for i, chunk in enumerate(chunks):
+            if utterance.cancelled:
+                return
+            cache_key = AudioCache.make_key(chunk, utterance.lang, engine.speaker, engine.sample_rate)
+            audio = self.audio_cache.get(cache_key)
+            if audio is None:
+                synthesis_started = time.monotonic()
+                audio = engine.synthesize(chunk)
+                self.record_synthesis(engine, utterance.lang, time.monotonic() - synthesis_started, len(audio))
+                self.audio_cache.put(cache_key, audio)
+            yield AudioClip(utterance, audio, engine.sample_rate, started,
+                            first=i == 0, last=i == len(chunks) - 1)
+
+    def engine_supports_batching(self, lang):
+        # Looked up on every batch, the engines can be replaced (benchmarks)
+        return getattr(self.engines.get(lang), 'supports_batching', False)
+
+    def synthesize_batch(self, utterances):
+        # Pipeline synthesis handler. The pipeline only batches utterances of
+        # one language, and only while playback is busy, so all chunks that
+        # are not cached yet go through the engine in one call and the clips
+        # are handed out afterwards, in the original order.
+        utterances = [utterance for utterance in utterances if not utterance.cancelled]
+        if not utterances:
+            return
+        if len(utterances) == 1:
+            yield from self.synthesize_utterance(utterances[0])
+            return
+        lang = utterances[0].lang
+        engine = self.engines.get(lang)
+        if engine is None:
+            logging.debug('No TTS engine configured for language: %s', lang)
+            return
+        engine.load()
+        started = time.monotonic()
+
+        planned = []
+        missing = {}
+        for utterance in utterances:
+            chunks = []
+            for chunk in self.split_utterance(utterance):
+                cache_key = AudioCache.make_key(chunk, lang, engine.speaker, engine.sample_rate)
+                audio = self.audio_cache.get(cache_key)
+                if audio is None:
+                    missing.setdefault(cache_key, chunk)
+                chunks.append((cache_key, audio))
+            planned.append((utterance, chunks))
+
+        logging.debug('Synthesizing %d chunks of %d utterances in one batch.', len(missing), len(utterances))
+        synthesis_started = time.monotonic()
+        synthesized = dict(zip(missing, engine.synthesize_batch(list(missing.values()))))
+        self.record_synthesis(engine, lang, time.monotonic() - synthesis_started,
+                              sum(len(audio) for audio in synthesized.values()))
+        for cache_key, audio in synthesized.items():
+            self.audio_cache.put(cache_key, audio)
+
+        for utterance, chunks in planned:
+            for i, (cache_key, audio) in enumerate(chunks):
+                if audio is None:
+                    audio = synthesized[cache_key]
+                yield AudioClip(utterance, audio, engine.sample_rate, started,
+                                first=i == 0, last=i == len(chunks) - 1)
+
+    def play_clip(self, clip):
+        if clip.utterance.cancelled:
+            return
+        if clip.first:
+            if self.callback:
+                self.callback(clip.utterance.text)
+            playback_started = time.monotonic()
+            self.report_time_to_first_audio(playback_started - clip.synthesis_started, clip.utterance.lang)
+            self.pipeline.record('end_to_end', playback_started - clip.utterance.received)
+        # The event is the clip's own, so cancelling it never cuts off the
+        # clip played after it
+        interrupted = threading.Event()
+        self.current_clip = (clip, interrupted)
         try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-        except Exception as e:
-            logging.debug(f"Failed to start subprocess: {e}")
-
-        sequential_strings = []
-        current_time = None
-        is_new_notification = False
-
-        while self.running:
-            line = process.stdout.readline().decode('utf-8').strip()
-            logging.debug(f'Intercepted line: {line}')
-
-            time_match = re.search(r'signal time=(\d+\.\d+)', line)
-            if time_match:
-                current_time = time_match.group(1)
-
-            if "member=Notify" in line:
-                logging.debug('Starting to process a new notification.')
-                sequential_strings = []
-                is_new_notification = True
-
-            string_match = re.search(r'string "([^"]+)"', line)
-            if string_match:
-                captured_string = string_match.group(1)
-                sequential_strings.append(captured_string)
-                logging.debug(f'Captured sequential string: {captured_string}')
-
-            if "signal time=" in line and "member=NotificationClosed" in line:
-                if not is_new_notification:
-                    logging.debug('Ignoring closed notification.')
-                    continue
-
-                logging.debug('Finished processing the notification.')
-                logging.debug(f'Sequential strings: {sequential_strings}')
-
-                source = sequential_strings[0] if sequential_strings else ''
-                self.current_source = source
-                rules = self.source_rules.get(source, [0, 1])
-
-                # Initialize actions with 'do not read' first
-                actions = ['do not read'] * len(sequential_strings)
-
-                # Apply simple rules to populate actions
-                if rules:
-                    for i in rules:
-                        if i < len(actions):
-                            actions[i] = 'read'
-
-                # Apply advanced rules to update actions
-                self.apply_advanced_rule(sequential_strings, source, actions)
-
-                # Group text by language
-                grouped_text = {'en': [], 'ru': []}
-
-                # Use the final actions array to decide what to read
-                for i, action in enumerate(actions):
-                    if i < len(sequential_strings):
-                        text_to_read = sequential_strings[i]
-                        if not text_to_read.strip():
-                            logging.debug("Skipping language detection due to empty text.")
-                        else:
-                            detected_lang = detect(text_to_read)
-                        lang = 'ru' if detected_lang == 'ru' else 'en'
-
-                        if action == 'read':
-                            grouped_text[lang].append(text_to_read)
-
-                # Process each language group
-                for lang, texts in grouped_text.items():
-                    if texts:
-                        combined_text = ', '.join(texts)
-                        logging.debug(f'Notification source: {source}')
-                        logging.debug(f'Final text to read: {combined_text}')
-                        logging.debug(f'Proceeding to TTS for language: {lang}.')
-                        self.read_text(combined_text, lang)
-                else:
-                    logging.debug(f'No rules found for source: {source}. Skipping.')
-
-                is_new_notification = False  # Reset the flag
+            if not clip.utterance.cancelled:
+                self.audio_output.play(clip.audio, clip.sample_rate, interrupted)
+        finally:
+            self.current_clip = None
+
+    def report_time_to_first_audio(self, elapsed, lang):
+        self.last_time_to_first_audio = elapsed
+        if elapsed > self.time_to_first_audio_target:
+            logging.warning('Time to first audio %.3fs for language %s is above the %.3fs target',
+                            elapsed, lang, self.time_to_first_audio_target)
+        else:
+            logging.debug('Time to first audio %.3fs for language %s', elapsed, lang)
+
+    def filter_notification(self, notification):
+        # Applies simple and advanced rules and returns the utterances to speak
+        sequential_strings = notification.sequential_strings
+        source = notification.source
+        self.current_source = source
+        # One snapshot for the whole notification, edits published meanwhile
+        # apply from the next one
+        snapshot = self.rules
+        rules = snapshot.source_index.get(source, [0, 1])
+
+        # Initialize actions with 'do not read' first
+        actions = ['do not read'] * len(sequential_strings)
+
+        # Apply simple rules to populate actions
+        if rules:
+            for i in rules:
+                if i < len(actions):
+                    actions[i] = 'read'
+
+        # Apply advanced rules to update actions
+        started = time.monotonic()
+        self.apply_advanced_rule(sequential_strings, source, actions, snapshot)
+        self.pipeline.record('rules', time.monotonic() - started)
+
+        # Group text by language
+        grouped_text = {'en': [], 'ru': []}
+
+        # Use the final actions array to decide what to read. Only entries
+        # that will be read need their language detected.
+        started = time.monotonic()
+        detected = False
+        for i, action in enumerate(actions):
+            if action != 'read' or i >= len(sequential_strings):
+                continue
+            text_to_read = sequential_strings[i]
+            if not text_to_read.strip():
+                logging.debug("Skipping empty text.")
+                continue
+            grouped_text[route_language(text_to_read)].append(text_to_read)
+            detected = True
+        if detected:
+            self.pipeline.record('detect', time.monotonic() - started)
+
+        utterances = []
+        for lang, texts in grouped_text.items():
+            if texts:
+                combined_text = ', '.join(texts)
+                logging.debug('Text to read from %s in %s: %s', source, lang, combined_text)
+                utterances.append(Utterance(combined_text, lang, source, notification.received,
+                                            notification=notification))
+        if utterances:
+            NOTIFICATIONS_READ.inc((source,))
+        else:
+            NOTIFICATIONS_FILTERED.inc((source,))
+            logging.debug('Nothing to read for source: %s. Skipping.', source)
+        if self.dedup is not None:
+            self.dedup.record_spoken(notification.content_key, sum(len(u.text) for u in utterances))
+        return utterances
+
+    async def run(self):
+        mode = self.settings['listener']['mode']
+        if mode == 'native' or (mode == 'auto' and native_listener_available()):
+            if native_listener_available():
+                await self.run_native()
+                return
+            logging.warning('jeepney is not installed, falling back to dbus-monitor.')
+        await self.run_dbus_monitor()
+
+    async def run_native(self):
+        listener = NativeNotificationListener(self.settings['listener']['bus_address'])
+        await listener.listen(self.assembler, self.pipeline.record)
+
+    def submit_notification(self, notification):
+        logging.debug('Sequential strings: %s', notification.sequential_strings)
+        NOTIFICATIONS_SEEN.inc((notification.source,))
+        # Repeats are dropped here, before language detection or synthesis
+        if self.dedup is not None and self.dedup.is_duplicate(notification):
+            NOTIFICATIONS_DUPLICATE.inc((notification.source,))
+            return
+        if notification.replaces is not None:
+            self.cancel_notification(notification.replaces, 'replaced')
+        # Hand over to the pipeline, synthesis and playback happen on its own threads
+        if not self.pipeline.submit(notification):
+            logging.debug('Notification dropped by the pipeline.')
+
+    async def run_dbus_monitor(self):
+        listener_settings = self.settings['listener']
+        listener = DbusMonitorListener(listener_settings['bus_address'],
+                                       restart_delay=listener_settings['restart_delay_seconds'])
+        await listener.listen(self.handle_monitor_message, self.pipeline.record)
+
+    def handle_monitor_message(self, message):
+        trace_message('Intercepted %s %s', message.kind, message.member)
+        args = message.args
+        if message.kind == 'method call' and message.member == 'Notify':
+            replaces_id = args[1] if len(args) > 1 and isinstance(args[1], int) else 0
+            self.assembler.notify(message.fields.get('sender'), message.int_field('serial'), message.strings(),
+                                  replaces_id)
+        elif message.kind == 'method return' and args:
+            self.assembler.reply(message.fields.get('destination'), message.int_field('reply_serial'), args[0])
+        elif message.kind == 'signal' and message.member == 'NotificationClosed' and len(args) == 2:
+            self.assembler.closed(*args)
+
+    def on_notification_id(self, notification):
+        if self.dedup is not None:
+            self.dedup.record_id(notification.notification_id, notification.content_key)
+
+    def on_notification_closed(self, notification, reason):
+        if reason in self.settings['listener']['cancel_on_close_reasons']:
+            self.cancel_notification(notification, f'closed (reason {reason})')
+
+    def cancel_notification(self, notification, why):
+        # Queued speech of the notification is dropped, and if it is being
+        # played right now, playback is cut off
+        notification.cancelled = True
+        removed = self.pipeline.cancel(notification)
+        current = self.current_clip
+        interrupted = current is not None and current[0].utterance.notification is notification
+        if interrupted:
+            current[1].set()
+        if removed or interrupted:
+            logging.debug('Notification from %s %s, stopped reading it.', notification.source, why)
 
     def load_advanced_rules(self):
-        advanced_rules_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'advanced_rules.json')
         try:
             if os.path.exists(self.advanced_rules_file_path):
                 with open(self.advanced_rules_file_path, 'r') as f:
-                    self.advanced_rules = json.load(f)
-            logging.debug(f"Successfully loaded advanced rules: {self.advanced_rules}")
+                    self.publish_rules(advanced_rules=json.load(f), save=False)
+            logging.debug("Successfully loaded advanced rules for %d sources.", len(self.advanced_rules))
         except FileNotFoundError:
-            self.advanced_rules = {}
+            self.publish_rules(advanced_rules={}, save=False)
             logging.debug("advanced_rules.json not found, initializing empty rules.")
         except Exception as e:
             logging.debug(f"Failed to load advanced rules. Error: {e}")
 
 
     def save_advanced_rules(self):
-        advanced_rules_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'advanced_rules.json')
+        # Published snapshots are saved already, this only forces a write
+        self.rule_store.save(self.advanced_rules_file_path, lambda: thaw(self.rules.advanced_rules))
+        logging.debug("Advanced rules will be saved.")
+
+
+class ReaderDaemon:
+    # Runs a reader without any UI and takes commands on the control socket
+    # (see control.py): start and stop reading, edit rules, get stats. Clients
+    # that subscribe get "reading" events with the text that starts playing
+    # and "status" events when reading starts or stops. The event loop only
+    # serves the socket and the notification source, so clients get their
+    # answers while models are busy.
+    def __init__(self, reader, path):
+        self.reader = reader
+        self.reader.callback = self.on_reading
+        self.path = path
+        self.loop = None
+        self.task = None
+        self.done = None
+        self.now_reading = None
+        self.server = ControlServer(path, {
+            'status': self.status,
+            'start': self.start_reading,
+            'stop': self.request_stop,
+            'shutdown': self.shutdown,
+            'get_rules': self.get_rules,
+            'update_rules': lambda rules: self.reader.update_rules(rules),
+            'delete_source_rule': lambda source: self.reader.delete_source_rule(source),
+            'set_advanced_rule': lambda source, entry_index, rule: self.reader.set_advanced_rule(source, entry_index, rule),
+            'delete_advanced_rule': lambda source, entry_index: self.reader.delete_advanced_rule(source, entry_index),
+            'update_advanced_rules': lambda advanced_rules: self.reader.update_advanced_rules(advanced_rules),
+            'get_stats': self.reader.get_stats,
+            'get_metrics_summary': self.reader.get_metrics_summary,
+        })
+
+    async def serve(self, start_reading=True):
+        self.loop = asyncio.get_running_loop()
+        self.done = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.done.set)
+        await self.server.start()
         try:
-            with open(self.advanced_rules_file_path, 'w') as f:
-                json.dump(self.advanced_rules, f)
-            logging.debug("Successfully saved advanced rules.")
-        except Exception as e:
-            logging.debug(f"Failed to save advanced rules. Error: {e}")
+            if start_reading:
+                self.start_reading()
+            await self.done.wait()
+        finally:
+            await self.stop_reading()
+            await self.server.close()
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def status(self):
+        return {
+            'running': self.running,
+            'ready': self.reader.startup.ready_after is not None,
+            'reading': self.now_reading,
+            'rules_version': self.reader.rules.version,
+            'pid': os.getpid(),
+        }
+
+    def start_reading(self):
+        if self.running:
+            return False
+        self.reader.running = True
+        self.task = asyncio.ensure_future(self.reader.run_async())
+        self.task.add_done_callback(lambda task: self.server.publish('status', **self.status()))
+        self.server.publish('status', **self.status())
+        return True
+
+    async def stop_reading(self):
+        if not self.running:
+            return False
+        # stop() joins the rule watcher and the pipeline threads, which must
+        # not hold up the loop
+        await self.loop.run_in_executor(None, self.reader.stop)
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.now_reading = None
+        return True
+
+    def request_stop(self):
+        # Answers right away; subscribers get a status event once reading stopped
+        if not self.running:
+            return False
+        asyncio.ensure_future(self.stop_reading())
+        return True
+
+    def shutdown(self):
+        self.done.set()
+        return True
+
+    def get_rules(self):
+        return {'source_rules': thaw(self.reader.source_rules), 'advanced_rules': thaw(self.reader.advanced_rules)}
+
+    def on_reading(self, text):
+        # Called on the playback thread
+        self.loop.call_soon_threadsafe(self.publish_reading, text)
+
+    def publish_reading(self, text):
+        self.now_reading = text
+        self.server.publish('reading', text=text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read notifications aloud, controlled through a local socket')
+    parser.add_argument('--idle', action='store_true', help='wait for a start command instead of reading right away')
+    parser.add_argument('--socket', help='control socket (default: from settings.json)')
+    args = parser.parse_args()
 
+    notification_reader = NotificationReader()
+    try:
+        daemon = ReaderDaemon(notification_reader, args.socket or socket_path(notification_reader.settings['control']))
+        asyncio.run(daemon.serve(start_reading=not args.idle))
+    except ControlError as e:
+        sys.exit(str(e))
 
 
 if __name__ == "__main__":
-    notification_reader = NotificationReader()
-    notification_reader.start()
+    main()
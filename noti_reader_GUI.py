@@ -1,48 +1,127 @@
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QSlider, QFormLayout, QLineEdit, QCheckBox, QDialog, QGridLayout, QTableWidgetItem, QTableWidget, QHeaderView, QComboBox, QHBoxLayout, QSplitter, QListWidget, QSizePolicy
-from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QThread
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QSlider, QFormLayout, QLineEdit, QCheckBox, QDialog, QGridLayout, QTableWidgetItem, QTableWidget, QHeaderView, QComboBox, QHBoxLayout, QSplitter, QListWidget, QSizePolicy, QGroupBox, QMessageBox
+from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QThread, QTimer
 from functools import partial
+import contextlib
 import sys
 import os
+import copy
 import json
 import logging
-logger = logging.getLogger('')
-if not logger.hasHandlers():
-    # Determine the directory where this script resides
-    current_script_path = os.path.dirname(os.path.abspath(__file__))
-    
-    # Create a 'logs' directory if it doesn't exist
-    logs_dir_path = os.path.join(current_script_path, 'logs')
-    os.makedirs(logs_dir_path, exist_ok=True)
-    
-    # Create a log file within that directory
-    log_file_path = os.path.join(logs_dir_path, 'debug.log')
-    
-    # Configure logging
-    logging.basicConfig(filename=log_file_path, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-    console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG)
-    logger.addHandler(console)
-
-from noti_reader import NotificationReader
-
-class NotificationThread(QThread):
+import subprocess
+from settings import load_settings, DEFAULT_SOURCE
+from log_setup import configure_logging
+# The daemon rotates logs/debug.log, the GUI keeps a file of its own
+configure_logging(dict(load_settings()['logging'], file=os.path.join('logs', 'gui.log')),
+                  os.path.dirname(os.path.abspath(__file__)))
+
+# The reader runs as a daemon of its own (noti_reader.py), so the GUI never
+# imports torch or the models and stays responsive during synthesis. It
+# talks to the daemon over the control socket.
+from control import ControlClient, ControlError, socket_path
+READER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'noti_reader.py')
+# Calls are made on the UI thread, so they give up quickly. Only Start waits
+# a little for a daemon the GUI has just launched.
+CALL_TIMEOUT = 2.0
+DAEMON_START_WAIT = 3.0
+
+
+def report_control_error(widget, error):
+    logging.warning(f"Reader daemon request failed: {error}")
+    QMessageBox.warning(widget, 'Reader daemon', str(error))
+
+
+@contextlib.contextmanager
+def reporting_control_errors(widget):
+    # A request the daemon cannot answer is reported instead of ending the GUI
+    try:
+        yield
+    except ControlError as e:
+        report_control_error(widget, e)
+
+
+class RemoteReader:
+    # The NotificationReader methods the dialogs use, forwarded to the
+    # daemon. Each call is a round trip, so the dialogs fetch the rules once
+    # per refresh with get_rules() and work on that copy.
+    def __init__(self, client):
+        self.client = client
+
+    def call(self, method, **params):
+        return self.client.call(method, params)
+
+    def get_rules(self):
+        # {'source_rules': {...}, 'advanced_rules': {...}}, plain dicts
+        return self.call('get_rules')
+
+    def update_rules(self, new_rules):
+        self.call('update_rules', rules=new_rules)
+
+    def delete_source_rule(self, source):
+        self.call('delete_source_rule', source=source)
+
+    def set_advanced_rule(self, source, entry_index, rule):
+        self.call('set_advanced_rule', source=source, entry_index=entry_index, rule=rule)
+
+    def delete_advanced_rule(self, source, entry_index):
+        return self.call('delete_advanced_rule', source=source, entry_index=entry_index)
+
+    def update_advanced_rules(self, advanced_rules):
+        self.call('update_advanced_rules', advanced_rules=advanced_rules)
+
+    def start(self):
+        return self.client.call('start', wait=DAEMON_START_WAIT)
+
+    def stop(self):
+        return self.call('stop')
+
+    def shutdown(self):
+        return self.call('shutdown')
+
+    def get_metrics_summary(self):
+        # Polled by a timer, so this never waits for a daemon to come up
+        try:
+            return self.client.call('get_metrics_summary')
+        except ControlError:
+            return None
+
+
+class DaemonEventThread(QThread):
+    # Receives the daemon's events and hands them to the UI thread as
+    # signals; reconnects when the daemon restarts
     newText = pyqtSignal(str)
+    statusChanged = pyqtSignal(bool)
 
-    def __init__(self):
-        super(NotificationThread, self).__init__()
-        self.reader = NotificationReader(callback=self.new_text_emitted)
+    def __init__(self, client):
+        super(DaemonEventThread, self).__init__()
+        self.client = client
+        self.sock = None
+        self.stopping = False
 
     def run(self):
-        logging.debug("NotificationThread: Starting NotificationReader.")
-        self.reader.start()
+        while not self.stopping:
+            try:
+                events = self.client.events()
+                self.sock = next(events)
+                for event in events:
+                    if event['event'] == 'reading':
+                        self.newText.emit(event['text'])
+                    elif event['event'] == 'status':
+                        self.statusChanged.emit(event['running'])
+            except (ControlError, OSError, ValueError) as e:
+                logging.debug(f"DaemonEventThread: {e}")
+            self.sock = None
+            if not self.stopping:
+                self.msleep(1000)
 
     def stop(self):
-        logging.debug("NotificationThread: Stopping NotificationReader.")
-        if self.reader:  # Make sure reader exists before calling stop
-            self.reader.stop()
-
-    def new_text_emitted(self, text):
-        self.newText.emit(text)
+        self.stopping = True
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(2)  # Wakes up the blocked read
+            except OSError:
+                pass
+        self.wait(2000)
 
 class AdvancedRuleDialog(QDialog):
     advancedRuleSet = pyqtSignal(int, str)  # New signal
@@ -107,57 +186,45 @@ class AdvancedRuleDialog(QDialog):
 
     def apply_and_close_advanced_rule(self):
         print("DEBUG: apply_and_close_advanced_rule() has been triggered.")
+        if_rule = {
+            "entry": self.if_combo_box.currentText(),
+            "condition": self.if_condition_combo_box.currentText(),
+            "value": self.if_value_edit.text()
+        }
+
+        then_rule = {
+            "entry": self.then_combo_box.currentText(),
+            "action": self.then_action_combo_box.currentText(),
+            "value": self.then_value_edit.text()
+        }
+
+        advanced_rule = {
+            "if": if_rule,
+            "then": then_rule,
+            "use_regex": self.regex_checkbox.isChecked()
+        }
+        advanced_rule_json = json.dumps(advanced_rule)
+        
+        # Debug line
+        print(f"DEBUG: Applying advanced rule: {advanced_rule}")  
+        
+        # Save the advanced rule to the parent dialog
+        self.parent().advanced_rules[self.entry_index] = advanced_rule  
+        
+        source = self.source
+        print(f"DEBUG: Source for the advanced rule is {source}")
+        
+        # Replaces the existing rule for the same entry_index if any, the
+        # reader gets a new rules snapshot with it. The dialog stays open if
+        # the daemon cannot take it.
         try:
-            if_rule = {
-                "entry": self.if_combo_box.currentText(),
-                "condition": self.if_condition_combo_box.currentText(),
-                "value": self.if_value_edit.text()
-            }
-
-            then_rule = {
-                "entry": self.then_combo_box.currentText(),
-                "action": self.then_action_combo_box.currentText(),
-                "value": self.then_value_edit.text()
-            }
-
-            advanced_rule = {
-                "if": if_rule,
-                "then": then_rule,
-                "use_regex": self.regex_checkbox.isChecked()
-            }
-            advanced_rule_json = json.dumps(advanced_rule)
-            
-            # Debug line
-            print(f"DEBUG: Applying advanced rule: {advanced_rule}")  
-            
-            # Save the advanced rule to the parent dialog
-            self.parent().advanced_rules[self.entry_index] = advanced_rule  
-            
-            source = self.source
-            print(f"DEBUG: Source for the advanced rule is {source}")
-            
-            # Initialize if the source does not exist
-            if source not in self.parent().thread.reader.advanced_rules:
-                self.parent().thread.reader.advanced_rules[source] = []
-            
-            # Remove existing rule for the same entry_index if any
-            self.parent().thread.reader.advanced_rules[source] = [rule for rule in self.parent().thread.reader.advanced_rules[source] if rule["entry_index"] != self.entry_index]
-            
-            # Append the new rule
-            self.parent().thread.reader.advanced_rules[source].append({"entry_index": self.entry_index, "rule": advanced_rule})
-            
-            self.parent().thread.reader.save_advanced_rules()
-            updated_entry_index = int(self.if_combo_box.currentText().split(" ")[-1]) - 1
-            self.advancedRuleSet.emit(self.entry_index, advanced_rule_json)
-            self.accept()  
-            
-            # Debug lines
-            print(f"DEBUG: self.parent() type: {type(self.parent())}")  
-            
-        except AttributeError:
-            print(f"DEBUG: Caught AttributeError. self.parent(): {self.parent()}, type: {type(self.parent())}")
-            print(f"DEBUG: self.parent().thread: {self.parent().thread}, type: {type(self.parent().thread)}")
-            raise
+            self.parent().reader.set_advanced_rule(source, self.entry_index, advanced_rule)
+        except ControlError as e:
+            report_control_error(self, e)
+            return
+        updated_entry_index = int(self.if_combo_box.currentText().split(" ")[-1]) - 1
+        self.advancedRuleSet.emit(self.entry_index, advanced_rule_json)
+        self.accept()  
 
 
     def populate_fields(self, rule, entry_index):
@@ -177,7 +244,12 @@ class AdvancedRuleDialog(QDialog):
 class FilterSettingsDialog(QDialog):
     def __init__(self, parent=None):
         super(FilterSettingsDialog, self).__init__(parent)
-        self.thread = NotificationThread()
+        # Rules are edited through the App window's connection to the reader
+        # daemon, so opening this dialog does not load any model. Advanced
+        # rule dialogs opened from here use it as well.
+        self.reader = parent.reader
+        # The reader's rules as of the last refresh_rules()
+        self.rules = {'source_rules': {}, 'advanced_rules': {}}
         self.source_list = QListWidget(self)
         layout = QGridLayout()
         layout.addWidget(QLabel("Reading Filter Settings"), 0, 0)
@@ -286,10 +358,14 @@ class FilterSettingsDialog(QDialog):
         self.setLayout(layout)
 
 
+    def refresh_rules(self):
+        # One round trip to the daemon; the table updates below read from it
+        self.rules = self.reader.get_rules()
+
     def update_rule_list(self):
-        print(f"DEBUG: Current source_rules: {self.parent().thread.reader.source_rules}")  # Debug line
+        self.refresh_rules()
         self.rule_table.setRowCount(0)
-        rules = self.parent().thread.reader.source_rules
+        rules = self.rules['source_rules']
         sorted_rules = sorted(rules.items(), key=lambda x: x[0].lower())
 
         for source, entries in rules.items():
@@ -308,9 +384,9 @@ class FilterSettingsDialog(QDialog):
 
     def delete_rule(self, source):
         if source != DEFAULT_SOURCE:  # Prevent deletion of the default entry
-            del self.parent().thread.reader.source_rules[source]
-            self.parent().thread.reader.update_rules({})
-            self.update_rule_list()
+            with reporting_control_errors(self):
+                self.reader.delete_source_rule(source)
+                self.update_rule_list()
 
     @pyqtSlot(QTableWidgetItem)
     def on_rule_clicked(self, item):
@@ -330,17 +406,19 @@ class FilterSettingsDialog(QDialog):
         self.third_entry_checkbox.setChecked(2 in entries)
         self.fourth_entry_checkbox.setChecked(3 in entries)
 
-        self.update_adv_rule_table(source.strip())
-        self.update_advanced_rule_labels()
+        with reporting_control_errors(self):
+            self.update_adv_rule_table(source.strip())
+            self.update_advanced_rule_labels()
 
     def update_adv_rule_table(self, source):
         logging.debug("Entering update_adv_rule_table")
 
+        self.refresh_rules()
         self.adv_rule_table.clearContents()  # Clear the contents
         self.adv_rule_table.setRowCount(0)  # Set row count to 0
 
-        if source and source in self.parent().thread.reader.advanced_rules:
-            advanced_rules = self.parent().thread.reader.advanced_rules[source]
+        if source and source in self.rules['advanced_rules']:
+            advanced_rules = self.rules['advanced_rules'][source]
             for rule_dict in advanced_rules:
                 
                 logging.debug(f"DEBUG: Processing rule_dict: {rule_dict}")  # Debug log
@@ -382,35 +460,22 @@ class FilterSettingsDialog(QDialog):
         self.delete_advanced_rule(entry_index)  # Assuming you have a method named `delete_advanced_rule`
 
     def delete_adv_rule(self, source, entry_index):
-        if source in self.parent().thread.reader.advanced_rules:
-            rule_list = self.parent().thread.reader.advanced_rules[source]
-            rule_to_remove = None
-            for r in rule_list:
-                if r["entry_index"] == entry_index:
-                    rule_to_remove = r
-                    break
-
-            if rule_to_remove is not None:
-                rule_list.remove(rule_to_remove)
-                # If the list becomes empty, remove the source entry
-                if not rule_list:
-                    del self.parent().thread.reader.advanced_rules[source]
-                    
-                self.parent().thread.reader.save_advanced_rules()  # Save the updated rules
+        with reporting_control_errors(self):
+            if self.reader.delete_advanced_rule(source, entry_index):
                 self.update_adv_rule_table(source)  # Refresh the table
             else:
                 print("DEBUG: No rule found for deletion.")
 
     # Call update_rule_list when the dialog is shown
     def show_and_execute_filter_settings(self):
-        self.update_rule_list()
-
         source = self.source_line_edit.text().strip()  # Getting source from QLineEdit
         if not source:  # If no source is set, you might set it to None or some default value.
             source = None  # Or any default source
 
-        self.update_adv_rule_table(source)  # Now providing source as an argument
-        self.update_advanced_rule_labels()
+        with reporting_control_errors(self):
+            self.update_rule_list()
+            self.update_adv_rule_table(source)  # Now providing source as an argument
+            self.update_advanced_rule_labels()
 
         super().exec_()
 
@@ -433,24 +498,20 @@ class FilterSettingsDialog(QDialog):
     def apply_filter_settings(self):
         logging.debug("FilterSettingsDialog: Applying settings.")
         new_rules = self.get_settings()
-        self.parent().thread.reader.update_rules(new_rules)
-
-        source = self.source_line_edit.text().strip()
-        # Updating only the source_rules, not touching advanced_rules here
-        if source:
-            advanced_rules_for_source = self.parent().thread.reader.advanced_rules.get(source, {})
-            if advanced_rules_for_source:
-                self.parent().thread.reader.advanced_rules[source] = advanced_rules_for_source
-            else:
+        with reporting_control_errors(self):
+            self.reader.update_rules(new_rules)
+
+            source = self.source_line_edit.text().strip()
+            # Updating only the source_rules, not touching advanced_rules here
+            self.refresh_rules()
+            advanced_rules = self.rules['advanced_rules']
+            if source and source in advanced_rules and not advanced_rules[source]:
                 # If there are no advanced rules for this source, ensure it doesn't exist in the dictionary
-                if source in self.parent().thread.reader.advanced_rules:
-                    del self.parent().thread.reader.advanced_rules[source]
-        
-        # Save advanced rules only if they exist
-        if self.parent().thread.reader.advanced_rules:
-            self.parent().thread.reader.save_advanced_rules()
-                
-        self.update_rule_list()
+                advanced_rules = dict(advanced_rules)
+                del advanced_rules[source]
+                self.reader.update_advanced_rules(advanced_rules)
+
+            self.update_rule_list()
         # Update UI
         self.update_advanced_rule_ui()
 
@@ -492,30 +553,15 @@ class FilterSettingsDialog(QDialog):
         source = self.source_line_edit.text().strip()
         print(f"DEBUG: Source set in FilterSettingsDialog: {source}")
 
-        if source not in self.parent().thread.reader.advanced_rules:
-            self.parent().thread.reader.advanced_rules[source] = []
-        elif not isinstance(self.parent().thread.reader.advanced_rules[source], list):
-            existing_rules = self.parent().thread.reader.advanced_rules[source]
-            self.parent().thread.reader.advanced_rules[source] = [{"entry_index": k, "rule": v} for k, v in existing_rules.items()]
-
         # Update the advanced rule using the received entry_index
-        for rule in self.parent().thread.reader.advanced_rules[source]:
-            if rule["entry_index"] == entry_index:
-                rule["rule"] = json.loads(advanced_rule_json)
-                break
-        else:
-            self.parent().thread.reader.advanced_rules[source].append({
-                "entry_index": entry_index,
-                "rule": json.loads(advanced_rule_json)
-            })
+        with reporting_control_errors(self):
+            self.reader.set_advanced_rule(source, entry_index, json.loads(advanced_rule_json))
 
-        self.parent().thread.reader.save_advanced_rules()
+            # Update the advanced_rules dictionary using the received entry_index
+            self.advanced_rules[entry_index] = advanced_rule_json
 
-        # Update the advanced_rules dictionary using the received entry_index
-        self.advanced_rules[entry_index] = advanced_rule_json
-        
-        self.update_adv_rule_table(source)
-        self.update_advanced_rule_labels()
+            self.update_adv_rule_table(source)
+            self.update_advanced_rule_labels()
         print(f"DEBUG: Updated advanced_rules: {self.advanced_rules}")
 
 
@@ -524,7 +570,7 @@ class FilterSettingsDialog(QDialog):
             logging.debug("No advanced rules to save. Skipping.")
             return
         source = self.source_line_edit.text().strip()
-        if source in self.parent().thread.reader.advanced_rules:
+        if source in self.rules['advanced_rules']:
             self.first_advanced_rule_label.show()
         else:
             self.first_advanced_rule_label.hide()
@@ -536,27 +582,39 @@ class FilterSettingsDialog(QDialog):
         new_value = item.text()
         source = self.source_line_edit.text().strip()
         
-        # Assuming entry_index is stored in the first column
-        entry_index = self.adv_rule_table.item(row, 0).text()
-        
-        if source in self.parent().thread.reader.advanced_rules:
-            if str(entry_index) in self.parent().thread.reader.advanced_rules[source]:
-                rule = self.parent().thread.reader.advanced_rules[source][entry_index]
-                
-                # Update the rule based on the column that was changed
-                if column == 1:  # 'If Condition'
-                    rule['if']['condition'] = new_value
-                elif column == 2:  # 'If Value'
-                    rule['if']['value'] = new_value
-                elif column == 3:  # 'Then Action'
-                    rule['then']['action'] = new_value
-                    
-                # Save the updated rules
-                self.parent().thread.reader.save_advanced_rules()
+        # The first column holds the "If Entry" of the rule
+        entry_item = self.adv_rule_table.item(row, 0)
+        if entry_item is None:
+            return
+        if_entry = entry_item.text()
+
+        # Edits go against the rules the table was filled from
+        for rule_dict in self.rules['advanced_rules'].get(source, ()):
+            if rule_dict['rule'].get('if', {}).get('entry') != if_entry:
+                continue
+            # The edit goes into a copy so it can be told apart from the table being filled
+            rule = copy.deepcopy(rule_dict['rule'])
+            rule.setdefault('if', {})
+            rule.setdefault('then', {})
+
+            # Update the rule based on the column that was changed
+            if column == 1:  # 'If Condition'
+                rule['if']['condition'] = new_value
+            elif column == 2:  # 'If Value'
+                rule['if']['value'] = new_value
+            elif column == 3:  # 'Then Action'
+                rule['then']['action'] = new_value
+
+            # Filling the table changes items too, only real edits are published
+            if rule != rule_dict['rule']:
+                with reporting_control_errors(self):
+                    self.reader.set_advanced_rule(source, rule_dict['entry_index'], rule)
+                    rule_dict['rule'] = rule
+            break
 
     def edit_adv_rule(self, source, entry_index):
         # Fetch the existing rule data for the specified source and entry_index
-        rule_list = self.parent().thread.reader.advanced_rules.get(source, [])
+        rule_list = self.rules['advanced_rules'].get(source, [])
         rule = None
         for r in rule_list:
             if r["entry_index"] == entry_index:
@@ -576,14 +634,52 @@ class FilterSettingsDialog(QDialog):
         
         dialog.advancedRuleSet.connect(self.set_advanced_rule_for_filter)
         dialog.exec_()
-        self.update_adv_rule_table(source)
+        with reporting_control_errors(self):
+            self.update_adv_rule_table(source)
+
+
+STAGE_LABELS = [('parse', 'parse'), ('rules', 'rules'), ('detect', 'detect'), ('synthesis', 'synthesis'),
+                ('playback', 'playback'), ('end_to_end', 'to speech')]
+
+
+def format_stats(summary):
+    if summary is None:
+        return 'Reader daemon not running'
+    notifications = summary['notifications']
+    lines = [f"Notifications: {notifications['seen']} seen, {notifications['read']} read, "
+             f"{notifications['filtered']} filtered, {notifications['duplicates']} repeats",
+             'Queued: ' + ', '.join(f'{name} {depth}' for name, depth in summary['queues'].items())
+             + f"; {summary['dropped']} dropped"]
+    timings = []
+    for stage, label in STAGE_LABELS:
+        stage_summary = summary['stages'].get(stage)
+        if stage_summary:
+            timings.append(f"{label} {stage_summary['p50'] * 1000:.2f}/{stage_summary['p95'] * 1000:.2f}")
+    lines.append('p50/p95 ms: ' + (', '.join(timings) or '-'))
+    lines.append('Real-time factor: ' + (', '.join(f'{name} {rtf:.2f}' for name, rtf in summary['rtf'].items()) or '-'))
+    return '\n'.join(lines)
 
 
 class App(QWidget):
     def __init__(self):
         super().__init__()
+        control_settings = load_settings()['control']
+        self.client = ControlClient(socket_path(control_settings), timeout=CALL_TIMEOUT)
+        self.reader = RemoteReader(self.client)
+        self.daemon_process = None
+        if control_settings['autostart_daemon']:
+            self.ensure_daemon()
         self.initUI()
 
+    def ensure_daemon(self):
+        # Starts the reader daemon (not reading yet) unless one is running.
+        # Only Start waits for it to come up, other calls fail until then.
+        try:
+            self.client.call('status')
+        except ControlError:
+            logging.debug("App: Starting the reader daemon.")
+            self.daemon_process = subprocess.Popen([sys.executable, READER_SCRIPT, '--idle'], start_new_session=True)
+
     def initUI(self):
         layout = QVBoxLayout()
 
@@ -612,11 +708,26 @@ class App(QWidget):
         self.quit_button.clicked.connect(self.quit_app)
         layout.addWidget(self.quit_button)
 
+        stats_box = QGroupBox('Stats')
+        stats_layout = QVBoxLayout()
+        self.stats_label = QLabel('')
+        self.stats_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        stats_layout.addWidget(self.stats_label)
+        stats_box.setLayout(stats_layout)
+        layout.addWidget(stats_box)
+
         self.setLayout(layout)
         self.setWindowTitle('TTS Control Panel')
 
-        self.thread = NotificationThread()
-        self.thread.newText.connect(self.update_reading_label)
+        self.events = DaemonEventThread(self.client)
+        self.events.newText.connect(self.update_reading_label)
+        self.events.statusChanged.connect(self.update_status_label)
+        self.events.start()
+
+        self.update_stats()
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_stats)
+        self.stats_timer.start(1000)
 
     def show_reading_filter(self):  
         self.filter_settings_dialog = FilterSettingsDialog(parent=self)
@@ -625,30 +736,60 @@ class App(QWidget):
 
     def start_tts(self):
         logging.debug("App: Starting TTS.")
-        self.status_label.setText('TTS Status: Started')
-        self.thread.start()
+        try:
+            self.reader.start()
+            self.status_label.setText('TTS Status: Started')
+        except ControlError as e:
+            self.status_label.setText(f'TTS Status: {e}')
 
     def stop_tts(self):
         logging.debug("App: Stopping TTS.")
-        self.status_label.setText('TTS Status: Stopped')
-        self.thread.stop()
+        try:
+            self.reader.stop()
+            self.status_label.setText('TTS Status: Stopped')
+        except ControlError as e:
+            self.status_label.setText(f'TTS Status: {e}')
 
     @pyqtSlot(str)
     def update_reading_label(self, text):
         self.reading_label.setText(f'Reading: {text}')
 
+    @pyqtSlot(bool)
+    def update_status_label(self, running):
+        self.status_label.setText('TTS Status: Started' if running else 'TTS Status: Stopped')
+
+    def update_stats(self):
+        self.stats_label.setText(format_stats(self.reader.get_metrics_summary()))
+
     def show_filter_settings(self):
-        dialog = FilterSettingsDialog()
+        dialog = FilterSettingsDialog(parent=self)
         result = dialog.exec_()
         if result == QDialog.Accepted:
             new_rules = dialog.get_settings()
-            self.thread.reader.update_rules(new_rules)    
+            with reporting_control_errors(self):
+                self.reader.update_rules(new_rules)
 
     def quit_app(self):
-        self.thread.stop()
+        # Reading stops with the GUI as before; a daemon the GUI started
+        # itself exits too
+        self.stats_timer.stop()
+        self.events.stop()
+        try:
+            if self.daemon_process is not None:
+                self.client.call('shutdown')
+            else:
+                self.client.call('stop')
+        except ControlError:
+            pass
+        self.client.close()
         self.close()
 
 app = QApplication(sys.argv)
-ex = App()
+try:
+    ex = App()
+except ControlError as e:
+    # No safe place for the control socket
+    QMessageBox.critical(None, 'Reader daemon', str(e))
+    sys.exit(1)
 ex.show()
 sys.exit(app.exec_())
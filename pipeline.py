@@ -0,0 +1,510 @@
+import time
+import logging
+import itertools
+import threading
+import collections
+from metrics import registry as metrics_registry
+
+# What a full queue does with one more item
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+SKIP_LOW_PRIORITY = 'skip_low_priority'
+BACKPRESSURE_POLICIES = (DROP_OLDEST, COALESCE, SKIP_LOW_PRIORITY)
+STAGES = ('parse', 'rules', 'detect', 'filter', 'synthesis', 'playback', 'end_to_end')
+# How long stop() waits for the stage threads, e.g. for a model call in flight
+STOP_TIMEOUT = 5.0
+STAGE_SECONDS = metrics_registry.histogram('noti_reader_stage_seconds',
+                                           'Time spent per notification or item in each stage', ['stage'])
+
+
+class Notification:
+    # A notification as captured from D-Bus, before any rule is applied
+    def __init__(self, sequential_strings, received=None, replaces_id=0):
+        self.sequential_strings = sequential_strings
+        self.source = sequential_strings[0] if sequential_strings else ''
+        self.received = received if received is not None else time.monotonic()
+        self.replaces_id = replaces_id
+        self.content_key = None  # Set by the dedup index
+        self.notification_id = None  # Set once the notification server replies
+        self.replaces = None  # The notification this one replaces, if it was seen
+        self.cancelled = False  # Closed or replaced before it was read
+
+
+class Utterance:
+    # Text that passed the rules and should be spoken in one language.
+    # count > 1 marks a summary standing in for that many notifications.
+    def __init__(self, text, lang, source, received, count=1, notification=None):
+        self.text = text
+        self.lang = lang
+        self.source = source
+        self.received = received
+        self.count = count
+        self.notification = notification
+
+    @property
+    def cancelled(self):
+        return self.notification is not None and self.notification.cancelled
+
+
+class AudioClip:
+    # Synthesized audio of one chunk of an utterance, ready to be played
+    def __init__(self, utterance, audio, sample_rate, synthesis_started, first=True, last=True):
+        self.utterance = utterance
+        self.audio = audio
+        self.sample_rate = sample_rate
+        self.synthesis_started = synthesis_started
+        self.first = first
+        self.last = last
+
+
+class BoundedQueue:
+    # A thread-safe FIFO with a fixed size. put() with block=False never waits:
+    # when the queue is full the backpressure policy decides what is dropped.
+    def __init__(self, name, maxsize, policy=DROP_OLDEST, priority=None, coalesce_key=None, merge=None):
+        if policy not in BACKPRESSURE_POLICIES:
+            logging.debug(f"Unknown backpressure policy {policy}, using {DROP_OLDEST}.")
+            policy = DROP_OLDEST
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.merge = merge
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, block=False):
+        with self.condition:
+            if block:
+                while len(self.items) >= self.maxsize and not self.closed:
+                    self.condition.wait()
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxsize:
+                item = self._make_room(item)
+                if item is None:
+                    return False
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def _make_room(self, item):
+        # Returns the item to append, or None if the new item itself was dropped
+        if self.policy == COALESCE and self.coalesce_key and self.merge:
+            key = self.coalesce_key(item)
+            for i, queued in enumerate(self.items):
+                if self.coalesce_key(queued) == key:
+                    self.items[i] = self.merge(queued, item)
+                    self.coalesced += 1
+                    self.condition.notify_all()
+                    return None
+        elif self.policy == SKIP_LOW_PRIORITY and self.priority:
+            lowest = min(self.items, key=self.priority)
+            self.dropped += 1
+            if self.priority(item) < self.priority(lowest):
+                return None
+            self.items.remove(lowest)
+            return item
+        self.items.popleft()
+        self.dropped += 1
+        return item
+
+    def get(self, timeout=None):
+        # Returns None when nothing arrived within timeout or the queue is closed
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def take_while(self, predicate, limit):
+        # Removes and returns up to limit items from the head of the queue, as
+        # long as they match predicate; the order of the rest is untouched
+        taken = []
+        with self.condition:
+            while self.items and len(taken) < limit and predicate(self.items[0]):
+                taken.append(self.items.popleft())
+            if taken:
+                self.condition.notify_all()
+        return taken
+
+    def discard(self, predicate):
+        # Removes every queued item that matches predicate
+        with self.condition:
+            kept = [item for item in self.items if not predicate(item)]
+            removed = len(self.items) - len(kept)
+            if removed:
+                self.items = collections.deque(kept)
+                self.condition.notify_all()
+        return removed
+
+    def clear(self):
+        with self.condition:
+            self.items.clear()
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def reopen(self):
+        with self.condition:
+            self.closed = False
+
+
+class SpeechScheduler:
+    # Decides which utterance is synthesized next, so the spoken backlog does
+    # not run minutes behind reality:
+    # - higher source priority first, arrival order within one priority
+    # - once utterances of coalesce_threshold notifications of one source are
+    #   waiting they are replaced by a single summary, e.g. "5 new messages
+    #   from Slack"; a notification read in two languages is one message
+    # - utterances older than ttl_seconds are dropped without being spoken
+    # - when the oldest utterance has waited max_latency_seconds, every source
+    #   with more than one notification waiting is summarized
+    # Same interface as BoundedQueue, so it can sit between pipeline stages.
+    def __init__(self, name, maxsize, policy, priority, settings):
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.priority = priority
+        self.ttl = settings.get('ttl_seconds', 120)
+        self.max_latency = settings.get('max_latency_seconds', 30)
+        self.coalesce_threshold = max(2, settings.get('coalesce_threshold', 3))
+        self.summary_templates = settings.get('summary', {})
+        self.entries = []  # [(sequence number, utterance)]
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def summary_text(self, lang, count, source):
+        template = self.summary_templates.get(lang) or self.summary_templates.get('en') or '{count} new messages from {source}'
+        return template.format(count=count, source=source)
+
+    def put(self, utterance, block=False):
+        # Never blocks; returns False if the utterance was dropped right away
+        with self.condition:
+            if self.closed:
+                return False
+            now = time.monotonic()
+            self._expire(now)
+            self.entries.append((next(self.sequence), utterance))
+            self._coalesce_source(utterance.source, self.coalesce_threshold)
+            self._catch_up(now)
+            while len(self.entries) > self.maxsize:
+                self._drop_one()
+            self.condition.notify_all()
+            return any(queued is utterance for _, queued in self.entries)
+
+    def _catch_up(self, now):
+        # Drops what is too old to be read and, once the oldest waiting
+        # utterance is past max_latency, summarizes every source. Runs when
+        # utterances are taken as well, so a backlog that goes stale without
+        # new arrivals is still summarized.
+        self._expire(now)
+        if self.entries and now - min(u.received for _, u in self.entries) > self.max_latency:
+            self._coalesce_all()
+
+    def _expire(self, now):
+        fresh = [(seq, u) for seq, u in self.entries if now - u.received <= self.ttl]
+        expired = len(self.entries) - len(fresh)
+        if expired:
+            logging.debug('%d utterances expired before they could be read.', expired)
+            self.expired += expired
+            self.entries = fresh
+
+    def _coalesce_source(self, source, threshold):
+        same_source = [(seq, u) for seq, u in self.entries if u.source == source]
+        # A summary counts the notifications it stands for, other utterances
+        # count once per notification
+        notifications = {id(u.notification) for _, u in same_source if u.notification is not None}
+        count = len(notifications) + sum(u.count for _, u in same_source if u.notification is None)
+        has_summary = any(u.count > 1 for _, u in same_source)
+        if count < threshold and not (has_summary and len(same_source) > 1):
+            return
+        first_seq, first = same_source[0]
+        # Said in the language most of the waiting speech is in, the first
+        # one on a tie
+        languages = collections.Counter()
+        for _, u in same_source:
+            languages[u.lang] += u.count
+        lang = max(languages, key=languages.get)
+        summary = Utterance(self.summary_text(lang, count, source), lang, source, first.received, count)
+        self.entries = [(seq, u) for seq, u in self.entries if u.source != source or seq == first_seq]
+        self.entries[[seq for seq, _ in self.entries].index(first_seq)] = (first_seq, summary)
+        self.coalesced += len(same_source) - 1
+
+    def _coalesce_all(self):
+        for source in {u.source for _, u in self.entries}:
+            self._coalesce_source(source, 2)
+
+    def _drop_one(self):
+        if self.policy == COALESCE:
+            before = len(self.entries)
+            self._coalesce_all()
+            if len(self.entries) < before:
+                return
+        if self.policy == SKIP_LOW_PRIORITY:
+            victim = min(self.entries, key=lambda entry: (self.priority(entry[1]), entry[0]))
+        else:
+            victim = self.entries[0]
+        self.entries.remove(victim)
+        self.dropped += 1
+
+    def _pop_next(self):
+        best = max(self.entries, key=lambda entry: (self.priority(entry[1]), -entry[0]))
+        self.entries.remove(best)
+        utterance = best[1]
+        self.max_wait = max(self.max_wait, time.monotonic() - utterance.received)
+        return utterance
+
+    def get(self, timeout=None):
+        with self.condition:
+            self._catch_up(time.monotonic())
+            if not self.entries and not self.closed:
+                self.condition.wait(timeout)
+                self._catch_up(time.monotonic())
+            if not self.entries:
+                return None
+            utterance = self._pop_next()
+            self.condition.notify_all()
+            return utterance
+
+    def take_while(self, predicate, limit):
+        # Takes the next utterances in scheduling order while they match
+        taken = []
+        with self.condition:
+            self._catch_up(time.monotonic())
+            while self.entries and len(taken) < limit:
+                best = max(self.entries, key=lambda entry: (self.priority(entry[1]), -entry[0]))
+                if not predicate(best[1]):
+                    break
+                taken.append(self._pop_next())
+        return taken
+
+    def discard(self, predicate):
+        with self.condition:
+            kept = [(seq, u) for seq, u in self.entries if not predicate(u)]
+            removed = len(self.entries) - len(kept)
+            self.entries = kept
+        return removed
+
+    def clear(self):
+        with self.condition:
+            self.entries = []
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def reopen(self):
+        with self.condition:
+            self.closed = False
+
+
+class StageStats:
+    # Totals for get_stats(), and every value in the stage histogram
+    def __init__(self, name):
+        self.name = name
+        self.labels = (name,)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.last = seconds
+            if seconds > self.max:
+                self.max = seconds
+        STAGE_SECONDS.observe(seconds, self.labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'avg_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'max_ms': self.max * 1000,
+                'last_ms': self.last * 1000,
+            }
+
+
+class Stage(threading.Thread):
+    # Takes items from input_queue, runs handler on each and puts everything the
+    # handler returns (or yields) on output_queue, in order. With collect set,
+    # the handler gets collect(item) instead, e.g. a batch of queued items.
+    def __init__(self, name, input_queue, handler, stats, output_queue=None, block_output=False, collect=None):
+        super(Stage, self).__init__(name=f'pipeline-{name}', daemon=True)
+        self.input_queue = input_queue
+        self.handler = handler
+        self.stats = stats
+        self.output_queue = output_queue
+        self.block_output = block_output
+        self.collect = collect
+        self.busy = False
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            item = self.input_queue.get(timeout=0.5)
+            if item is None:
+                continue
+            if self.collect is not None:
+                item = self.collect(item)
+            if self.stopping.is_set():
+                break  # Taken while stop() was clearing the queues
+            self.busy = True
+            started = time.monotonic()
+            # Time spent waiting for room in the next queue is backpressure
+            # from the stages after this one, not work done here
+            waited = 0.0
+            try:
+                for result in self.handler(item) or ():
+                    # Whatever finishes after stop() is discarded, so a model
+                    # call that was in flight cannot be heard after a restart
+                    if self.stopping.is_set():
+                        break
+                    if self.output_queue is not None:
+                        put_started = time.monotonic()
+                        self.output_queue.put(result, block=self.block_output)
+                        waited += time.monotonic() - put_started
+            except Exception as e:
+                logging.exception(f"Pipeline stage {self.name} failed: {e}")
+            self.busy = False
+            self.stats.record(time.monotonic() - started - waited)
+
+    def stop(self):
+        self.stopping.set()
+
+
+class SpeechPipeline:
+    # notifications -> filter -> utterances -> synthesis -> audio -> playback
+    #
+    # Intake only ever appends to the notification queue, so reading D-Bus is
+    # never held up by synthesis or playback. The audio queue blocks the
+    # synthesis stage when playback falls behind, which in turn lets the
+    # utterance scheduler fill up and apply the configured backpressure policy.
+    #
+    # The synthesis handler receives a list of utterances. While playback is
+    # busy, queued utterances of the same language are handed over together
+    # (up to max_batch_size) so they can be synthesized in one model call,
+    # if can_batch(lang) says the engine of that language has batched
+    # inference; for any other engine a batch would only be a loop that
+    # delays the first clip.
+    def __init__(self, filter_handler, synthesis_handler, playback_handler, settings, scheduler_settings=None,
+                 can_batch=None):
+        queue_size = settings.get('queue_size', 20)
+        self.max_batch_size = settings.get('max_batch_size', 8)
+        self.can_batch = can_batch or (lambda lang: True)
+        policy = settings.get('backpressure', DROP_OLDEST)
+        self.source_priorities = settings.get('source_priorities', {})
+
+        self.notifications = BoundedQueue('notifications', settings.get('intake_queue_size', 100), policy,
+                                          priority=self.priority)
+        self.utterances = SpeechScheduler('utterances', queue_size, policy, self.priority, scheduler_settings or {})
+        self.audio = BoundedQueue('audio', settings.get('audio_queue_size', 4))
+        self.queues = (self.notifications, self.utterances, self.audio)
+
+        self.stats = {name: StageStats(name) for name in STAGES}
+        self.handlers = (filter_handler, synthesis_handler, playback_handler)
+        self.stages = []
+        self.lock = threading.Lock()  # Serializes start() and stop()
+
+    def priority(self, item):
+        return self.source_priorities.get(item.source, 0)
+
+    def playback_busy(self):
+        return len(self.audio) > 0 or any(stage.busy for stage in self.stages if stage.name == 'pipeline-playback')
+
+    def collect_batch(self, utterance):
+        # Batching only pays off when something is already playing; otherwise
+        # the first utterance would wait for the whole batch to be synthesized
+        if self.max_batch_size <= 1 or not self.can_batch(utterance.lang) or not self.playback_busy():
+            return [utterance]
+        same_language = self.utterances.take_while(lambda queued: queued.lang == utterance.lang, self.max_batch_size - 1)
+        return [utterance] + same_language
+
+    def start(self):
+        with self.lock:
+            if self.stages:
+                return
+            for queue in self.queues:
+                queue.reopen()
+            filter_handler, synthesis_handler, playback_handler = self.handlers
+            stages = [
+                Stage('filter', self.notifications, filter_handler, self.stats['filter'], self.utterances),
+                Stage('synthesis', self.utterances, synthesis_handler, self.stats['synthesis'], self.audio,
+                      block_output=True, collect=self.collect_batch),
+                Stage('playback', self.audio, playback_handler, self.stats['playback']),
+            ]
+            for stage in stages:
+                stage.start()
+            self.stages = stages
+
+    def stop(self, interrupt=None, timeout=STOP_TIMEOUT):
+        # Queued items are dropped and the stage threads exit once the item in
+        # hand is done; interrupt() is called after they were told to stop,
+        # to cut short a handler that would keep one busy (playback). Returns
+        # when the threads have exited, or after timeout.
+        with self.lock:
+            stages, self.stages = self.stages, []
+            for stage in stages:
+                stage.stop()
+            for queue in self.queues:
+                queue.close()
+                queue.clear()
+        if interrupt is not None:
+            interrupt()
+        deadline = time.monotonic() + timeout
+        for stage in stages:
+            # A stage stopping the pipeline cannot wait for itself
+            if stage is threading.current_thread() or stage.ident is None:
+                continue
+            stage.join(max(deadline - time.monotonic(), 0.0))
+            if stage.is_alive():
+                logging.debug('Pipeline stage %s did not stop within %.1fs.', stage.name, timeout)
+
+    def submit(self, notification):
+        return self.notifications.put(notification)
+
+    def cancel(self, notification):
+        # Drops everything still queued for the notification; the stages skip
+        # whatever of it they already hold
+        removed = self.notifications.discard(lambda queued: queued is notification)
+        removed += self.utterances.discard(lambda utterance: utterance.notification is notification)
+        removed += self.audio.discard(lambda clip: clip.utterance.notification is notification)
+        return removed
+
+    def record(self, stage_name, seconds):
+        self.stats[stage_name].record(seconds)
+
+    def get_stats(self):
+        return {
+            'queues': {queue.name: {'depth': len(queue), 'dropped': queue.dropped, 'coalesced': queue.coalesced}
+                       for queue in self.queues},
+            'scheduler': {'expired': self.utterances.expired, 'max_wait_ms': self.utterances.max_wait * 1000},
+            'stages': {name: stats.snapshot() for name, stats in self.stats.items()},
+        }
+
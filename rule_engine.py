@@ -0,0 +1,288 @@
+import re
+import fnmatch
+import logging
+from lang_detect import is_in_language
+
+# Conditions and actions offered by the advanced rule editor in the GUI
+CONTAINS = 'contains words/symbols'
+NOT_CONTAINS = 'does not contain words/symbols'
+IN_LANGUAGE = 'is in language'
+WORD_COUNT = 'has this amount of words'
+
+READ = 'read'
+DO_NOT_READ = 'do not read'
+READ_CERTAIN_WORDS = 'read certain words'
+
+QUOTED_TERM_RE = re.compile(r'"[^"]+"')
+WORD_TERM_RE = re.compile(r'\b\w+\b')
+OPERATOR_RE = re.compile(r'\b(?:AND|OR)\b')
+DIGITS_RE = re.compile(r'\d+')
+
+# Sources in the rule files may be patterns: 're:<regex>' or 'glob:<glob>' (e.g. 'glob:*Chrome*')
+REGEX_SOURCE_PREFIX = 're:'
+GLOB_SOURCE_PREFIX = 'glob:'
+MAX_CACHED_SOURCES = 4096
+
+
+class EntryTexts:
+    # View over the sequential strings of one notification. Splitting an entry
+    # into words is done at most once, no matter how many rules test it.
+    def __init__(self, sequential_strings):
+        self.strings = sequential_strings
+        self._split_cache = {}
+        self._hits_cache = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def text(self, index):
+        return self.strings[index]
+
+    def _split(self, index):
+        cached = self._split_cache.get(index)
+        if cached is None:
+            words = self.strings[index].split()
+            cached = self._split_cache[index] = (len(words), frozenset(words))
+        return cached
+
+    def words(self, index):
+        return self._split(index)[1]
+
+    def word_count(self, index):
+        return self._split(index)[0]
+
+    def term_hits(self, index, scanner):
+        hits = self._hits_cache.get(index)
+        if hits is None:
+            hits = self._hits_cache[index] = scanner.scan(self.strings[index], self.words(index))
+        return hits
+
+    def replace(self, index, text):
+        self.strings[index] = text
+        self._split_cache.pop(index, None)
+        self._hits_cache.pop(index, None)
+
+
+class TermScanner:
+    # All phrases and words used by the plain-text rules of one entry of one
+    # source. The entry is scanned once and every rule reads its result.
+    def __init__(self, phrases, words):
+        self.phrases = frozenset(phrases)
+        self.words = frozenset(words)
+        self.phrase_re = None
+        if self.phrases:
+            # Longest first, so at each position the lookahead reports the
+            # longest phrase starting there; the shorter phrases it contains
+            # are recorded as hits through self.implied.
+            ordered = sorted(self.phrases, key=len, reverse=True)
+            self.phrase_re = re.compile('(?=(' + '|'.join(re.escape(p) for p in ordered) + '))')
+            self.implied = {p: frozenset(q for q in self.phrases if q in p) for p in self.phrases}
+
+    def scan(self, text, words):
+        # Returns (phrases found in text, words found among its whole words)
+        found_phrases = set()
+        if self.phrase_re is not None:
+            for match in self.phrase_re.finditer(text):
+                phrase = match.group(1)
+                if phrase not in found_phrases:
+                    found_phrases |= self.implied[phrase]
+                    if len(found_phrases) == len(self.phrases):
+                        break
+        return found_phrases, self.words & words
+
+
+class CompiledRule:
+    # One advanced rule with everything that can be derived from its JSON
+    # (regexes, terms, operators, target entry) worked out ahead of time.
+    def __init__(self, entry_index, rule):
+        self.entry_index = entry_index
+        self.rule = rule
+        self.valid = True
+
+        if_rule = rule.get('if', {})
+        self.condition = if_rule.get('condition', '')
+        value = if_rule.get('value', '')
+
+        self.pattern = None
+        self.phrases = ()
+        self.words = ()
+        self.any_term = False
+        self.language = None
+        self.word_count = None
+
+        if self.condition in (CONTAINS, NOT_CONTAINS):
+            if rule.get('use_regex', False):
+                try:
+                    self.pattern = re.compile(value)
+                except re.error as e:
+                    logging.debug(f"Invalid regex {value!r} in advanced rule, rule disabled: {e}")
+                    self.valid = False
+            else:
+                # Quoted terms are matched as substrings, bare terms as whole words
+                self.phrases = tuple(term.strip('"') for term in QUOTED_TERM_RE.findall(value))
+                unquoted = QUOTED_TERM_RE.sub('', value)
+                operators = OPERATOR_RE.findall(unquoted)
+                self.words = tuple(term for term in WORD_TERM_RE.findall(unquoted) if term not in ('AND', 'OR'))
+                self.any_term = 'OR' in operators
+        elif self.condition == IN_LANGUAGE:
+            self.language = value
+        elif self.condition == WORD_COUNT:
+            try:
+                self.word_count = int(value)
+            except ValueError:
+                logging.debug(f"Invalid word count {value!r} in advanced rule, rule disabled.")
+                self.valid = False
+        else:
+            self.valid = False
+
+        then_rule = rule.get('then', {})
+        self.action = then_rule.get('action', '')
+        self.replacement = then_rule.get('value', '')
+        target_match = DIGITS_RE.search(then_rule.get('entry', str(entry_index)))
+        self.target_index = int(target_match.group()) - 1 if target_match else entry_index
+
+    def matches(self, entries, scanner=None):
+        if not self.valid:
+            return False
+        index = self.entry_index
+
+        if self.condition in (CONTAINS, NOT_CONTAINS):
+            wanted = self.condition == CONTAINS
+            if self.pattern is not None:
+                return (self.pattern.search(entries.text(index)) is not None) == wanted
+            found_phrases, found_words = entries.term_hits(index, scanner)
+            results = [(phrase in found_phrases) == wanted for phrase in self.phrases]
+            results.extend((word in found_words) == wanted for word in self.words)
+            return any(results) if self.any_term else all(results)
+
+        if self.condition == IN_LANGUAGE:
+            return is_in_language(entries.text(index), self.language)
+
+        if self.condition == WORD_COUNT:
+            return entries.word_count(index) == self.word_count
+
+        return False
+
+    def apply(self, entries, actions):
+        if self.action in (READ, DO_NOT_READ):
+            if self.target_index < len(actions):
+                actions[self.target_index] = self.action
+        elif self.action == READ_CERTAIN_WORDS:
+            if self.target_index < len(entries):
+                entries.replace(self.target_index, self.replacement)
+                actions[self.target_index] = READ
+
+
+class SourceRules:
+    # The compiled rules of one source, with one shared TermScanner per entry.
+    # by_length[n] holds the rules that can apply to a notification with n
+    # entries (entry_index < n), in file order, so apply() does no bounds checks.
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        phrases, words = {}, {}
+        for rule in self.rules:
+            if rule.valid and rule.pattern is None and rule.condition in (CONTAINS, NOT_CONTAINS):
+                phrases.setdefault(rule.entry_index, set()).update(rule.phrases)
+                words.setdefault(rule.entry_index, set()).update(rule.words)
+        self.scanners = {index: TermScanner(phrases[index], words[index]) for index in phrases}
+        longest = max((rule.entry_index for rule in self.rules), default=-1) + 1
+        self.by_length = [tuple((rule, self.scanners.get(rule.entry_index)) for rule in self.rules if rule.entry_index < n)
+                          for n in range(longest + 1)]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def apply(self, sequential_strings, actions):
+        entries = EntryTexts(sequential_strings)
+        for rule, scanner in self.by_length[min(len(entries), len(self.by_length) - 1)]:
+            if rule.matches(entries, scanner):
+                rule.apply(entries, actions)
+        return actions
+
+
+def source_matcher(source):
+    # None for a plain source name, otherwise a function telling whether a
+    # notification source matches the pattern. Only prefixed names are
+    # patterns, so a source such as 'Telegram [beta]' is matched literally.
+    if source.startswith(REGEX_SOURCE_PREFIX):
+        try:
+            return re.compile(source[len(REGEX_SOURCE_PREFIX):]).search
+        except re.error as e:
+            logging.debug(f"Invalid source pattern {source!r}, rules ignored: {e}")
+            return lambda name: False
+    if source.startswith(GLOB_SOURCE_PREFIX):
+        return re.compile(fnmatch.translate(source[len(GLOB_SOURCE_PREFIX):])).match
+    return None
+
+
+class SourceIndex:
+    # Finds what the rule files hold for a notification source: exact names
+    # through a dict, then 'glob:' and 're:' patterns in file order. With combine
+    # set, everything that matches (exact name first) is combined into one
+    # value, otherwise the first match wins. Every source is resolved once and
+    # then served from the cache; a new rules snapshot brings a new index, so
+    # the cache never outlives the rules it was built from.
+    def __init__(self, values, combine=None):
+        self.exact = {}
+        self.patterns = []
+        for source, value in values.items():
+            matcher = source_matcher(source)
+            if matcher is None:
+                self.exact[source] = value
+            else:
+                self.patterns.append((matcher, value))
+        self.combine = combine
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.exact) + len(self.patterns)
+
+    def get(self, source, default=None):
+        try:
+            found = self.cache[source]
+        except KeyError:
+            found = self.resolve(source)
+            if len(self.cache) >= MAX_CACHED_SOURCES:
+                self.cache.clear()
+            self.cache[source] = found
+        return default if found is None else found
+
+    def resolve(self, source):
+        exact = self.exact.get(source)
+        if self.combine is None:
+            if exact is not None or not self.patterns:
+                return exact
+            return next((value for match, value in self.patterns if match(source)), None)
+        found = [exact] if exact is not None else []
+        found.extend(value for match, value in self.patterns if match(source))
+        if len(found) > 1:
+            return self.combine(found)
+        return found[0] if found else None
+
+
+def merge_source_rules(source_rules):
+    return SourceRules(rule for rules in source_rules for rule in rules.rules)
+
+
+def compile_advanced_rules(advanced_rules):
+    # Turns the contents of advanced_rules.json into {source: SourceRules},
+    # see index_advanced_rules() for looking sources up
+    compiled = {}
+    for source, rule_entries in advanced_rules.items():
+        if not isinstance(rule_entries, (list, tuple)):
+            logging.debug(f"Skipping malformed advanced rules for source {source}.")
+            continue
+        compiled_rules = []
+        for rule_entry in rule_entries:
+            try:
+                compiled_rules.append(CompiledRule(int(rule_entry["entry_index"]), rule_entry["rule"]))
+            except (KeyError, TypeError, ValueError) as e:
+                logging.debug(f"Skipping malformed advanced rule for source {source}: {e}")
+        compiled[source] = SourceRules(compiled_rules)
+    return compiled
+
+
+def index_advanced_rules(advanced_rules):
+    # A notification gets the rules of its own source and of every pattern
+    # matching it
+    return SourceIndex(compile_advanced_rules(advanced_rules), combine=merge_source_rules)
@@ -0,0 +1,169 @@
+import os
+import time
+import json
+import logging
+import threading
+from types import MappingProxyType
+from rule_engine import SourceIndex, index_advanced_rules
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+def freeze(value):
+    # dicts -> read-only mappings, lists -> tuples, all the way down
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    # The other way round: a plain, editable (and JSON serializable) copy
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class RuleSnapshot:
+    # One version of all rules, never changed after it is built. The reader
+    # takes one snapshot per notification and uses only that; editors build
+    # the next version from thawed copies and publish it by replacing the
+    # reference, so neither side needs a lock.
+    def __init__(self, version, source_rules, advanced_rules):
+        self.version = version
+        self.source_rules = freeze(source_rules)
+        self.advanced_rules = freeze(advanced_rules)
+        # Lookups by notification source, patterns included
+        self.source_index = SourceIndex(self.source_rules)
+        self.compiled_rules = index_advanced_rules(self.advanced_rules)
+
+    def replace(self, source_rules=None, advanced_rules=None):
+        return RuleSnapshot(self.version + 1,
+                            self.source_rules if source_rules is None else source_rules,
+                            self.advanced_rules if advanced_rules is None else advanced_rules)
+
+
+def write_json_atomic(path, data):
+    # Readers (and a crash half way through) only ever see the old or the new file
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class RuleStore:
+    # Keeps the rule files and the reader in sync:
+    # - save(path, get_data) writes the file save_delay seconds after the last
+    #   call, so a burst of GUI edits becomes one write, via temp file + rename
+    # - watch() reports files changed by someone else (an editor, another
+    #   reader) to on_change(path); inotify is used when inotify_simple is
+    #   installed, otherwise the files are polled every poll_interval seconds
+    # Writes made by the store itself are recognized by their file signature
+    # and not reported back.
+    def __init__(self, paths, on_change, save_delay=0.5, poll_interval=1.0):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.on_change = on_change
+        self.save_delay = save_delay
+        self.poll_interval = poll_interval
+        self.signatures = {path: file_signature(path) for path in self.paths}
+        self.pending = {}  # {path: get_data}
+        self.timer = None
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.watching = False
+
+    def save(self, path, get_data):
+        # get_data is called at write time, so the latest edit is what gets written
+        with self.lock:
+            self.pending[os.path.abspath(path)] = get_data
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.save_delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            for path, get_data in pending.items():
+                try:
+                    write_json_atomic(path, get_data())
+                    self.signatures[path] = file_signature(path)
+                    logging.debug(f'Saved rules to {path}')
+                except Exception as e:
+                    logging.warning(f'Failed to save rules to {path}: {e}')
+
+    def watch(self):
+        if self.watcher is not None:
+            return
+        self.watching = True
+        target = self._watch_inotify if INotify is not None else self._watch_polling
+        self.watcher = threading.Thread(target=target, name='rule-store-watcher', daemon=True)
+        self.watcher.start()
+
+    def stop(self):
+        self.watching = False
+        if self.watcher is not None:
+            self.watcher.join(timeout=self.poll_interval + 1)
+            self.watcher = None
+        self.flush()
+
+    def _check(self, path):
+        with self.lock:
+            # An edit waiting to be written wins over the file on disk
+            if path in self.pending:
+                return
+            signature = file_signature(path)
+            if signature == self.signatures.get(path):
+                return
+            self.signatures[path] = signature
+        logging.debug(f'Rule file changed on disk: {path}')
+        try:
+            self.on_change(path)
+        except Exception as e:
+            logging.warning(f'Failed to reload rules from {path}: {e}')
+
+    def _watch_polling(self):
+        while self.watching:
+            for path in self.paths:
+                self._check(path)
+            time.sleep(self.poll_interval)
+
+    def _watch_inotify(self):
+        # The directories are watched rather than the files, so a file that is
+        # replaced by a rename (like the store's own writes) stays watched
+        inotify = INotify()
+        watched = {}
+        try:
+            mask = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.DELETE
+            for directory in {os.path.dirname(path) for path in self.paths}:
+                watched[inotify.add_watch(directory, mask)] = directory
+            # Edits made while nothing was watching (e.g. while the daemon
+            # was idle) produce no event, the signatures catch them
+            for path in self.paths:
+                self._check(path)
+            while self.watching:
+                for event in inotify.read(timeout=int(self.poll_interval * 1000)):
+                    path = os.path.join(watched.get(event.wd, ''), event.name)
+                    if path in self.paths:
+                        self._check(path)
+        finally:
+            inotify.close()
@@ -0,0 +1,172 @@
+import os
+import json
+import copy
+import logging
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.json')
+# Source rules for every source without rules of its own; it cannot be deleted
+DEFAULT_SOURCE = 'Default - all notifications'
+
+# Everything here can be overridden from settings.json next to this file.
+# Only the keys present in the file are replaced, the rest keep these values.
+DEFAULT_SETTINGS = {
+    'tts': {
+        'ru': {
+            'engine': 'silero',
+            'model_id': 'v4_ru',
+            'speaker': 'aidar',
+            'sample_rate': 48000,
+        },
+        'en': {
+            'engine': 'vits',
+            'model_name': 'tts_models/en/vctk/vits',
+            'speaker': 'p230',
+        },
+        # Seconds from the start of synthesis to the start of playback
+        'time_to_first_audio_target': 1.0,
+        # Long texts are synthesized sentence by sentence while earlier
+        # sentences are already playing; chunks are at most this long
+        'streaming': True,
+        'chunk_max_chars': 250,
+    },
+    'inference': {
+        # torch intra-op and inter-op threads, 0 keeps the torch default.
+        # Keeping them low leaves CPU for the desktop while speech is synthesized.
+        'num_threads': 2,
+        'num_interop_threads': 1,
+        # 'none' or 'dynamic_int8' (int8 Linear/LSTM weights, VITS only)
+        'quantize': 'none',
+        # Freeze and optimize TorchScript models for inference (Silero only)
+        'optimize_jit': False,
+    },
+    'models': {
+        # Local model store, see model_store.py; relative to this file
+        'dir': 'models',
+        # Fetch models from the network when they are not in the store
+        'allow_download': True,
+    },
+    'logging': {
+        # DEBUG traces every notification; INFO only reports startup and problems
+        'level': 'INFO',
+        # Relative to the scripts; rotated at max_bytes, backup_count old files kept
+        'file': 'logs/debug.log',
+        'max_bytes': 5 * 1024 * 1024,
+        'backup_count': 3,
+        'console': True,
+        # Per-message D-Bus tracing at DEBUG is limited to this many lines a second
+        'trace_max_per_second': 10,
+    },
+    'listener': {
+        # 'native' receives Notify calls directly over D-Bus (needs jeepney),
+        # 'dbus-monitor' scrapes the dbus-monitor output, 'auto' prefers native
+        'mode': 'auto',
+        # 'SESSION' or a D-Bus address such as 'unix:path=/tmp/test-bus'
+        'bus_address': 'SESSION',
+        # dbus-monitor is started again this long after it exits (doubling up to 30s)
+        'restart_delay_seconds': 1.0,
+        # Speech of a notification closed for one of these reasons is cut off:
+        # 1 expired, 2 dismissed by the user, 3 closed by the app
+        'cancel_on_close_reasons': [2, 3],
+    },
+    'audio': {
+        # 'sounddevice' plays through PortAudio (needs the sounddevice package),
+        # 'pipe' feeds raw 16-bit PCM to a long-lived pipe_command process,
+        # 'auto' prefers sounddevice
+        'backend': 'auto',
+        # {rate} is replaced by the sample rate, e.g. for PulseAudio/PipeWire:
+        # ['pacat', '--playback', '--raw', '--rate={rate}', '--channels=1', '--format=s16le']
+        'pipe_command': ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', '1', '-r', '{rate}'],
+    },
+    'cache': {
+        # Synthesized audio kept in memory for repeated phrases
+        'max_bytes': 64 * 1024 * 1024,
+        # Also keep it on disk so it survives restarts; a relative
+        # disk_dir is resolved next to this file
+        'disk': False,
+        'disk_dir': 'audio_cache',
+        'disk_max_bytes': 256 * 1024 * 1024,
+    },
+    'pipeline': {
+        # Notifications waiting for the rules to be applied
+        'intake_queue_size': 100,
+        # Utterances waiting for synthesis
+        'queue_size': 20,
+        # Synthesized clips waiting for playback; synthesis waits when it is full
+        'audio_queue_size': 4,
+        # What a full queue drops: 'drop_oldest', 'coalesce' (summarize every
+        # source with several waiting utterances first) or 'skip_low_priority'
+        # (drop the waiting item with the lowest priority)
+        'backpressure': 'drop_oldest',
+        # Queued utterances of one language synthesized together while
+        # something is playing, for engines with batched inference (VITS);
+        # 1 disables batching
+        'max_batch_size': 8,
+        # {source: priority}, higher is read first; unlisted sources have priority 0
+        'source_priorities': {},
+    },
+    'rules': {
+        # Reload source_rules.json and advanced_rules.json when they change on disk
+        'watch': True,
+        # Edits are written this long after the last one, all in one write
+        'save_delay_seconds': 0.5,
+        # How often the files are checked when inotify_simple is not installed
+        'poll_interval_seconds': 1.0,
+    },
+    'dedup': {
+        'enabled': True,
+        # The same notification seen again within this many seconds is not read
+        'window_seconds': 30,
+        # Notifications remembered at most
+        'max_entries': 1000,
+    },
+    'scheduler': {
+        # Utterances that waited longer than this are dropped unspoken
+        'ttl_seconds': 120,
+        # When the oldest waiting utterance is this old, all bursts are summarized
+        'max_latency_seconds': 30,
+        # Utterances of this many waiting notifications from one source become one summary
+        'coalesce_threshold': 3,
+        # Summary per language; {count} and {source} are filled in
+        'summary': {
+            'en': '{count} new messages from {source}',
+            'ru': '{source}: новых сообщений — {count}',
+        },
+    },
+    'metrics': {
+        # Prometheus text format at /metrics, only ever on a local endpoint
+        'enabled': True,
+        'host': '127.0.0.1',
+        'port': 9477,
+        # A path here serves the metrics on a Unix socket instead of a port
+        'unix_socket': '',
+    },
+    'control': {
+        # Unix socket of the reader daemon; empty means
+        # $XDG_RUNTIME_DIR/noti_reader-<uid>.sock, or a private directory
+        # /tmp/noti_reader-<uid> when XDG_RUNTIME_DIR is not set
+        'socket': '',
+        # The GUI starts the daemon when none is running, and stops it on quit
+        'autostart_daemon': True,
+    },
+}
+
+
+def merge_settings(defaults, overrides):
+    merged = copy.deepcopy(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_settings(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_settings(path=SETTINGS_PATH):
+    try:
+        with open(path, 'r') as f:
+            return merge_settings(DEFAULT_SETTINGS, json.load(f))
+    except FileNotFoundError:
+        logging.debug("settings.json not found, using default settings.")
+    except Exception as e:
+        logging.debug(f"Failed to load settings, using defaults. Error: {e}")
+    return copy.deepcopy(DEFAULT_SETTINGS)
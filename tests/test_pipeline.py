@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import SpeechScheduler, Utterance, Notification, DROP_OLDEST
+
+SUMMARY = {'en': '{count} new messages from {source}'}
+
+
+def scheduler(**settings):
+    settings.setdefault('summary', SUMMARY)
+    return SpeechScheduler('utterances', 20, DROP_OLDEST, lambda utterance: 0, settings)
+
+
+def utterance(source, text, lang='en'):
+    notification = Notification([source, text])
+    return Utterance(text, lang, source, notification.received, notification=notification)
+
+
+class StaleBacklogTest(unittest.TestCase):
+    # The backlog goes past max_latency_seconds after the last put, so only
+    # taking from the scheduler can notice it
+
+    def fill(self, queue):
+        for source in ('Slack', 'Telegram', 'Mail', 'Chat', 'News'):
+            queue.put(utterance(source, f'{source} one'))
+            queue.put(utterance(source, f'{source} two'))
+        self.assertEqual(len(queue), 10)  # Below coalesce_threshold per source
+        time.sleep(0.3)
+
+    def test_get_summarizes_stale_backlog(self):
+        queue = scheduler(max_latency_seconds=0.2, coalesce_threshold=3)
+        self.fill(queue)
+        taken = []
+        while True:
+            item = queue.get(timeout=0)
+            if item is None:
+                break
+            taken.append(item)
+        self.assertEqual(len(taken), 5)
+        self.assertTrue(all(item.notification is None and item.count == 2 for item in taken))
+        self.assertEqual(taken[0].text, '2 new messages from Slack')
+
+    def test_take_while_summarizes_stale_backlog(self):
+        queue = scheduler(max_latency_seconds=0.2, coalesce_threshold=3)
+        self.fill(queue)
+        taken = queue.take_while(lambda item: True, 20)
+        self.assertEqual([item.count for item in taken], [2] * 5)
+
+    def test_take_while_expires(self):
+        queue = scheduler(ttl_seconds=0.2)
+        queue.put(utterance('Slack', 'old'))
+        time.sleep(0.3)
+        self.assertEqual(queue.take_while(lambda item: True, 20), [])
+        self.assertEqual(queue.expired, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,348 @@
+import os
+import re
+import time
+import logging
+import threading
+import numpy as np
+import model_store
+
+# torch and Coqui TTS are imported only when a model is actually loaded, so
+# importing this module (and noti_reader) stays fast
+
+
+def torch_memory_bytes(model):
+    # Bytes held by the parameters and buffers of a torch model. Silero keeps
+    # the actual torch module in a .model attribute of its wrapper.
+    for module in (model, getattr(model, 'model', None)):
+        if module is None or not hasattr(module, 'parameters'):
+            continue
+        try:
+            tensors = list(module.parameters()) + list(module.buffers())
+        except Exception:
+            continue
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    return 0
+
+
+class ModelRegistry:
+    # Loads every TTS model at most once per process, on first use, and shares
+    # it between all engines, readers and GUI dialogs that ask for it
+    def __init__(self):
+        self.models = {}
+        self.info = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, key, loader, memory_bytes=torch_memory_bytes):
+        model = self.models.get(key)
+        if model is not None:
+            return model
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        # Only callers of the same model wait for each other while it loads
+        with key_lock:
+            model = self.models.get(key)
+            if model is None:
+                started = time.monotonic()
+                model = loader()
+                load_seconds = time.monotonic() - started
+                self.info[key] = {'load_seconds': load_seconds, 'bytes': memory_bytes(model)}
+                self.models[key] = model
+                logging.debug(f'Loaded TTS model {key} in {load_seconds:.2f}s, {self.info[key]["bytes"] / 2 ** 20:.1f} MiB')
+            return model
+
+    def is_loaded(self, key):
+        return key in self.models
+
+    def get_stats(self):
+        return {
+            'models': {'/'.join(map(str, key)): dict(info) for key, info in self.info.items()},
+            'total_bytes': sum(info['bytes'] for info in self.info.values()),
+        }
+
+
+registry = ModelRegistry()
+
+DEFAULT_INFERENCE = {'num_threads': 0, 'num_interop_threads': 0, 'quantize': 'none', 'optimize_jit': False}
+# Synthesizer.tts appends this many zero samples after every sentence
+SENTENCE_PAUSE_SAMPLES = 10000
+
+torch_threads_configured = False
+
+
+def configure_torch_threads(inference):
+    # Thread counts are process wide and the interop count can only be set
+    # before torch runs anything in parallel, so this is done once, before
+    # the first model loads. 0 keeps the torch default.
+    global torch_threads_configured
+    if torch_threads_configured:
+        return
+    torch_threads_configured = True
+    import torch
+    if inference.get('num_threads'):
+        torch.set_num_threads(inference['num_threads'])
+    if inference.get('num_interop_threads'):
+        try:
+            torch.set_num_interop_threads(inference['num_interop_threads'])
+        except RuntimeError as e:
+            logging.warning(f'Could not set torch interop threads: {e}')
+    logging.debug(f'torch threads: {torch.get_num_threads()}, interop threads: {torch.get_num_interop_threads()}')
+
+
+def quantize_dynamic_int8(module):
+    # int8 weights for Linear and LSTM layers, activations stay float
+    import torch
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+
+
+def optimize_script_module(module):
+    # Freezes a TorchScript module and lets torch fuse ops for inference
+    import torch
+    return torch.jit.optimize_for_inference(torch.jit.freeze(module.eval()))
+
+
+def inference_profile_key(inference):
+    return (inference.get('quantize', 'none'), bool(inference.get('optimize_jit')))
+
+
+class SileroEngine:
+    # Silero TTS, loaded from the local model store, or through torch.hub
+    # when the model is not in the store and downloads are allowed
+    supports_batching = False  # apply_tts takes one text at a time
+
+    def __init__(self, language='ru', model_id='v4_ru', speaker='aidar', sample_rate=48000,
+                 store=None, allow_download=True, inference=None, **kwargs):
+        self.language = language
+        self.model_id = model_id
+        self.speaker = speaker
+        self.sample_rate = sample_rate
+        self.device = 'cpu'
+        self.store = store
+        self.allow_download = allow_download
+        self.inference = dict(DEFAULT_INFERENCE, **(inference or {}))
+        self.model_key = ('silero', language, model_id) + inference_profile_key(self.inference)
+        self.model = None
+        self.torch = None
+
+    def load(self):
+        if self.model is None:
+            self.model = registry.get(self.model_key, self._load_model)
+            import torch
+            self.torch = torch
+
+    def _load_model(self):
+        configure_torch_threads(self.inference)
+        import torch
+        from torch.package import PackageImporter
+        key = model_store.silero_key(self.language, self.model_id)
+        path = self.store.verified_path(key, f'{self.model_id}.pt') if self.store else None
+        if path:
+            # The same loading code as the hubconf of silero-models, minus the network
+            model = PackageImporter(path).load_pickle('tts_models', 'model')
+        elif self.allow_download:
+            logging.warning(f'{key} is not in the model store, loading it through torch.hub.')
+            model, _ = torch.hub.load(repo_or_dir='snakers4/silero-models',
+                                      model='silero_tts',
+                                      language=self.language,
+                                      speaker=self.model_id)
+        else:
+            raise RuntimeError(f'{key} is not in the model store, run `python model_store.py fetch` first.')
+        model.to(torch.device(self.device))
+        self._optimize(model)
+        return model
+
+    def _optimize(self, model):
+        # Silero ships its network as a TorchScript module inside a Python
+        # wrapper. Dynamic quantization needs a plain nn.Module, so only the
+        # TorchScript optimizations apply here.
+        if self.inference['quantize'] != 'none':
+            logging.info('Silero models are TorchScript, dynamic quantization is not applied to them.')
+        script_module = getattr(model, 'model', None)
+        if self.inference['optimize_jit'] and script_module is not None:
+            try:
+                model.model = optimize_script_module(script_module)
+            except Exception as e:
+                logging.warning(f'TorchScript optimization failed for Silero, using the model as is: {e}')
+
+    def synthesize(self, text):
+        self.load()
+        with self.torch.inference_mode():
+            audio = self.model.apply_tts(text=text,
+                                         speaker=self.speaker,
+                                         sample_rate=self.sample_rate)
+        return audio.squeeze().numpy()
+
+    def synthesize_batch(self, texts):
+        # Silero's apply_tts takes a single text, so a batch is synthesized
+        # one text after another within one inference context. The pipeline
+        # does not batch for this engine, see supports_batching.
+        self.load()
+        audios = []
+        with self.torch.inference_mode():
+            for text in texts:
+                audio = self.model.apply_tts(text=text,
+                                             speaker=self.speaker,
+                                             sample_rate=self.sample_rate)
+                audios.append(audio.squeeze().numpy())
+        return audios
+
+
+class VitsEngine:
+    # Coqui TTS VITS model kept in memory, so the model is loaded once and not
+    # on every notification like the `tts` command line tool does
+    supports_batching = True  # See _synthesize_padded_batch()
+
+    def __init__(self, language='en', model_name='tts_models/en/vctk/vits', speaker='p230',
+                 store=None, allow_download=True, inference=None, **kwargs):
+        self.language = language
+        self.model_name = model_name
+        self.speaker = speaker
+        self.store = store
+        self.allow_download = allow_download
+        self.inference = dict(DEFAULT_INFERENCE, **(inference or {}))
+        self.sample_rate = None
+        self.model_key = ('vits', model_name) + inference_profile_key(self.inference)
+        self.tts = None
+        self.torch = None
+
+    def load(self):
+        if self.tts is None:
+            self.tts = registry.get(self.model_key, self._load_model,
+                                    lambda tts: torch_memory_bytes(tts.synthesizer.tts_model))
+            self.sample_rate = self.tts.synthesizer.output_sample_rate
+            import torch
+            self.torch = torch
+
+    def _load_model(self):
+        configure_torch_threads(self.inference)
+        key = model_store.vits_key(self.model_name)
+        if self.store and self.store.verified_path(key):
+            # Coqui looks for downloaded models under TTS_HOME and only goes
+            # to the network when the model is not there
+            os.environ['TTS_HOME'] = model_store.coqui_home(self.store.models_dir)
+        elif self.allow_download:
+            logging.warning(f'{key} is not in the model store, Coqui TTS will download it.')
+        else:
+            raise RuntimeError(f'{key} is not in the model store, run `python model_store.py fetch` first.')
+        from TTS.api import TTS
+        tts = TTS(model_name=self.model_name, progress_bar=False, gpu=False)
+        self._optimize(tts)
+        return tts
+
+    def _optimize(self, tts):
+        # VITS is a regular nn.Module; it cannot be scripted as a whole, so
+        # optimize_jit does not apply to it
+        if self.inference['quantize'] == 'dynamic_int8':
+            try:
+                tts.synthesizer.tts_model = quantize_dynamic_int8(tts.synthesizer.tts_model)
+            except Exception as e:
+                logging.warning(f'Dynamic quantization failed for {self.model_name}, using float weights: {e}')
+        if self.inference['optimize_jit']:
+            logging.info('VITS cannot be compiled to TorchScript, optimize_jit is not applied to it.')
+
+    def synthesize(self, text):
+        self.load()
+        with self.torch.inference_mode():
+            audio = self.tts.tts(text=text, speaker=self.speaker)
+        return np.asarray(audio, dtype=np.float32)
+
+    def synthesize_batch(self, texts):
+        self.load()
+        if len(texts) > 1:
+            try:
+                return self._synthesize_padded_batch(texts)
+            except Exception as e:
+                logging.debug(f'Batched VITS inference failed, synthesizing one by one: {e}')
+        return [self.synthesize(text) for text in texts]
+
+    def _synthesize_padded_batch(self, texts):
+        # Runs all texts through the VITS model in one forward pass: token ids
+        # are zero-padded to the longest text, x_lengths masks the padding, and
+        # each waveform is cut back to its own length using the output mask.
+        # Unlike Synthesizer.tts a text is not split into sentences again;
+        # the texts are chunks cut at sentence ends already, only short
+        # sentences sharing a chunk are spoken in one go.
+        torch = self.torch
+        model = self.tts.synthesizer.tts_model
+        token_ids = [model.tokenizer.text_to_ids(text) for text in texts]
+        lengths = torch.tensor([len(ids) for ids in token_ids], dtype=torch.long)
+        inputs = torch.zeros(len(texts), int(lengths.max()), dtype=torch.long)
+        for row, ids in enumerate(token_ids):
+            inputs[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        speaker_id = model.speaker_manager.name_to_id[self.speaker]
+        speaker_ids = torch.full((len(texts),), speaker_id, dtype=torch.long)
+
+        with torch.inference_mode():
+            outputs = model.inference(inputs, aux_input={'x_lengths': lengths, 'speaker_ids': speaker_ids})
+        hop_length = model.config.audio.hop_length
+        frames = outputs['y_mask'].sum(dim=(1, 2)).long()
+        waveforms = outputs['model_outputs'].squeeze(1)
+        return [self._postprocess(waveforms[row, :int(frames[row]) * hop_length].numpy().astype(np.float32))
+                for row in range(len(texts))]
+
+    def _postprocess(self, wav):
+        # What Synthesizer.tts does to every sentence after inference, so a
+        # batched clip sounds like one synthesized alone: the trailing silence
+        # is trimmed if the model config asks for it, then the pause that
+        # follows a sentence is added
+        synthesizer = self.tts.synthesizer
+        if synthesizer.tts_config.audio['do_trim_silence'] is True:
+            from TTS.tts.utils.synthesis import trim_silence
+            wav = trim_silence(wav, synthesizer.tts_model.ap)
+        return np.concatenate([wav, np.zeros(SENTENCE_PAUSE_SAMPLES, dtype=np.float32)])
+
+
+SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+|\n+')
+CLAUSE_END_RE = re.compile(r'(?<=[,;:])\s+')
+
+
+def split_into_chunks(text, max_chars=250):
+    # Splits text at sentence ends (then at clause ends and spaces when a
+    # sentence is too long) so synthesis can start with a short first chunk.
+    # After the first chunk, sentences are joined up to max_chars again.
+    pieces = []
+    for sentence in SENTENCE_END_RE.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for clause in CLAUSE_END_RE.split(sentence):
+            while len(clause) > max_chars:
+                cut = clause.rfind(' ', 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                pieces.append(clause[:cut].strip())
+                clause = clause[cut:].strip()
+            if clause:
+                pieces.append(clause)
+
+    chunks = pieces[:1]
+    for piece in pieces[1:]:
+        if len(chunks) > 1 and len(chunks[-1]) + len(piece) + 1 <= max_chars:
+            chunks[-1] = f'{chunks[-1]} {piece}'
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+ENGINE_CLASSES = {
+    'silero': SileroEngine,
+    'vits': VitsEngine,
+}
+
+
+def create_engines(tts_settings, store=None, allow_download=True, inference=None):
+    # Builds {language: engine} from the 'tts' section of the settings
+    engines = {}
+    for language, engine_settings in tts_settings.items():
+        if not isinstance(engine_settings, dict):
+            continue
+        engine_class = ENGINE_CLASSES.get(engine_settings.get('engine'))
+        if engine_class is None:
+            logging.debug(f"Unknown TTS engine for language {language}: {engine_settings.get('engine')}")
+            continue
+        engines[language] = engine_class(language=language, store=store, allow_download=allow_download,
+                                         inference=inference, **engine_settings)
+    return engines